@@ -1,20 +1,92 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import (
+    BooleanField,
+    Case,
+    ExpressionWrapper,
+    F,
+    FloatField,
+    IntegerField,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Now, NullIf
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 from posthog.utils import compact_number
 
-from .models import OrganizationBilling, Plan
+from .models import DailyTeamUsage, OrganizationBilling, Plan
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that uses Postgres' estimated number of rows of the table for unfiltered querysets, instead of running
+    a `COUNT(*)` over the whole table. The exact count is used for filtered querysets and small tables.
+    """
+
+    EXACT_COUNT_THRESHOLD: int = 10000
+
+    @cached_property
+    def count(self) -> int:
+        if self.object_list.query.where:
+            return super().count
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples FROM pg_class WHERE relname = %s", [self.object_list.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+
+        estimate: int = int(row[0]) if row else 0
+        return estimate if estimate >= self.EXACT_COUNT_THRESHOLD else super().count
+
+
+class AllocationUsageFilter(admin.SimpleListFilter):
+    title = "usage of event allocation"
+    parameter_name = "allocation_usage"
+
+    def lookups(self, request, model_admin):
+        return (
+            ("over", "Over allocation (100% or more)"),
+            ("near", "Near allocation (75% to 100%)"),
+            ("under", "Under 75%"),
+            ("unlimited", "Unlimited allocation"),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == "over":
+            return queryset.filter(usage_percentage__gte=100)
+        if self.value() == "near":
+            return queryset.filter(usage_percentage__gte=75, usage_percentage__lt=100)
+        if self.value() == "under":
+            return queryset.filter(usage_percentage__lt=75)
+        if self.value() == "unlimited":
+            return queryset.filter(allocation__isnull=True)
+        return queryset
+
+
+class OrganizationBillingChangeList(ChangeList):
+    def get_ordering(self, request, queryset):
+        # Organizations with unlimited allocation (no % of allocation) are sorted last in both directions
+        return [
+            getattr(F("usage_percentage"), "desc" if field.startswith("-") else "asc")(nulls_last=True)
+            if isinstance(field, str) and field.lstrip("-") == "usage_percentage"
+            else field
+            for field in super().get_ordering(request, queryset)
+        ]
 
 
 @admin.register(OrganizationBilling)
 class OrganizationBillingAdmin(admin.ModelAdmin):
-    search_fields = (
-        "organization__name",
-        "organization__members__email",
-        "stripe_customer_id",
-        "stripe_checkout_session",
-        "stripe_subscription_item_id",
-        "stripe_subscription_id",
-    )
+    search_fields = ("search_text",)  # organization name, member emails & Stripe IDs (see `get_search_results`)
     list_display = (
         "get_organization_name",
         "stripe_customer_id",
@@ -22,7 +94,14 @@ class OrganizationBillingAdmin(admin.ModelAdmin):
         "should_setup_billing",
         "billing_period_ends",
         "plan",
+        "get_is_billing_active",
+        "get_month_usage",
+        "get_usage_percentage",
     )
+    list_filter = (AllocationUsageFilter,)
+    list_select_related = ("organization", "plan")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # avoids a second count of the whole table when filtering
     readonly_fields = ["stripe", "billing_docs", "is_billing_active", "event_allocation"]
     fields = (
         "organization",
@@ -40,11 +119,73 @@ class OrganizationBillingAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.order_by("should_setup_billing")
+        is_billing_active = Q(plan__isnull=False, should_setup_billing=False, billing_period_ends__gt=Now())
+        start_of_month = timezone.now().date().replace(day=1)
+
+        return (
+            qs.annotate(
+                # same logic as `OrganizationBilling.is_billing_active`, computed by the database
+                billing_active=ExpressionWrapper(is_billing_active, output_field=BooleanField()),
+                # same logic as `OrganizationBilling.event_allocation`
+                allocation=Case(
+                    When(is_billing_active, then=F("plan__event_allowance")),
+                    default=Value(settings.BILLING_NO_PLAN_EVENT_ALLOCATION),
+                    output_field=IntegerField(),
+                ),
+                # usage is read from the daily rollup (i.e. doesn't include today) with one subquery, no ClickHouse
+                month_usage=Coalesce(
+                    Subquery(
+                        DailyTeamUsage.objects.filter(
+                            team__organization_id=OuterRef("organization_id"), date__gte=start_of_month,
+                        )
+                        .values("team__organization_id")
+                        .annotate(total=Sum("event_count"))
+                        .values("total")[:1],
+                        output_field=IntegerField(),
+                    ),
+                    0,
+                ),
+            )
+            .annotate(
+                usage_percentage=ExpressionWrapper(
+                    F("month_usage") * 100.0 / NullIf(F("allocation"), 0), output_field=FloatField(),
+                ),
+            )
+            .order_by("should_setup_billing")
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+
+        # `search_text` is indexed with trigrams, so substring searches don't need to scan (or join) other tables
+        return queryset.filter(search_text__contains=search_term.strip().lower()), False
 
     def get_organization_name(self, obj):
         return obj.organization.name
 
+    def get_is_billing_active(self, obj) -> bool:
+        return obj.billing_active
+
+    get_is_billing_active.boolean = True  # type: ignore
+    get_is_billing_active.short_description = "Billing active"  # type: ignore
+    get_is_billing_active.admin_order_field = "billing_active"  # type: ignore
+
+    def get_month_usage(self, obj) -> str:
+        return compact_number(obj.month_usage)
+
+    get_month_usage.short_description = "Usage this month"  # type: ignore
+    get_month_usage.admin_order_field = "month_usage"  # type: ignore
+
+    def get_usage_percentage(self, obj) -> str:
+        return f"{obj.usage_percentage:.0f}%" if obj.usage_percentage is not None else "-"
+
+    get_usage_percentage.short_description = "% of allocation"  # type: ignore
+    get_usage_percentage.admin_order_field = "usage_percentage"  # type: ignore  # NULLs last, see `get_changelist`
+
+    def get_changelist(self, request, **kwargs):
+        return OrganizationBillingChangeList
+
     def event_allocation(self, instance: OrganizationBilling) -> str:
         return "Unlimited" if not instance.event_allocation else compact_number(instance.event_allocation)
 
@@ -4,4 +4,7 @@ import posthoganalytics # type: ignore
 
 class MultiTenancyConfig(AppConfig):
     name = 'multi_tenancy'
-    verbose_name = "MultiTenancy"
\ No newline at end of file
+    verbose_name = "MultiTenancy"
+
+    def ready(self):
+        from . import signals  # noqa: F401 (registers the signal receivers)
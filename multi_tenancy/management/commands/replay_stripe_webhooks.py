@@ -0,0 +1,164 @@
+import datetime
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import dateutil
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from multi_tenancy.models import StripeWebhookEvent
+from multi_tenancy.stripe import list_events
+from multi_tenancy.webhooks import (
+    get_handled_event_types,
+    get_stale_processing_filter,
+    ingest_stripe_webhook_event,
+    process_stripe_webhook_event_by_id,
+)
+
+# (event, ID of the stored `StripeWebhookEvent` if already stored)
+ReplayedEvent = Tuple[Dict, Optional[int]]
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays Stripe webhook events for a time window through the regular webhook processing, e.g. to recover from"
+        " an outage. Events that were already processed (or are being processed) are skipped; events whose processing"
+        " was abandoned are processed again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", required=True, help="Replay events from this date (ISO 8601).")
+        parser.add_argument("--until", help="Replay events until this date (ISO 8601). Defaults to now.")
+        parser.add_argument(
+            "--source",
+            choices=["local", "stripe"],
+            default="local",
+            help="`local` replays stored events that were not processed successfully; `stripe` fetches the events"
+            " from Stripe (including events we never received).",
+        )
+        parser.add_argument("--batch-size", type=int, default=100, help="Number of events replayed per batch.")
+        parser.add_argument(
+            "--concurrency", type=int, default=4, help="Maximum number of events processed concurrently.",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Only list the events that would be replayed.")
+
+    def handle(self, *args, **options):
+        since: datetime.datetime = _parse_date(options["since"])
+        until: datetime.datetime = _parse_date(options["until"]) if options["until"] else timezone.now()
+
+        if since >= until:
+            raise CommandError("`--since` must be before `--until`.")
+
+        events: List[ReplayedEvent] = (
+            list(_get_local_events(since, until))
+            if options["source"] == "local"
+            else list(_get_stripe_events(since, until))
+        )
+        self.stdout.write(f"Found {len(events)} events to replay from {options['source']}.")
+
+        results: Dict[str, List[str]] = {"processed": [], "failed": [], "skipped": []}
+        batch_size: int = options["batch_size"]
+
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            for i in range(0, len(events), batch_size):
+                batch: List[ReplayedEvent] = events[i : i + batch_size]
+
+                if options["dry_run"]:
+                    for event, _ in batch:
+                        self.stdout.write(f"Would replay {event['id']} ({event['type']}, created {event['created']})")
+                    continue
+
+                stored_events: List[ReplayedEvent] = [
+                    (event, webhook_event_id if webhook_event_id else _store_event(event))
+                    for event, webhook_event_id in batch
+                ]
+
+                # Events of the same customer are processed sequentially (in order); customers concurrently
+                groups: List[List[ReplayedEvent]] = _group_by_customer(stored_events)
+
+                for group_results in (
+                    executor.map(_process_events_in_thread, groups)
+                    if options["concurrency"] > 1
+                    else map(_process_events, groups)
+                ):
+                    for key in results.keys():
+                        results[key] += group_results[key]
+
+                self.stdout.write(f"Replayed {min(i + batch_size, len(events))}/{len(events)} events.")
+
+        if not options["dry_run"]:
+            for stripe_event_id in results["skipped"]:
+                self.stdout.write(f"Skipped {stripe_event_id} (already processed or being processed).")
+
+            self.stdout.write(
+                f"Done. Processed: {len(results['processed'])}. Failed: {len(results['failed'])}."
+                f" Skipped: {len(results['skipped'])}."
+            )
+
+
+def _parse_date(value: str) -> datetime.datetime:
+    try:
+        date = dateutil.parser.isoparse(value)
+    except ValueError:
+        raise CommandError(f"Invalid date: {value}")
+
+    return date if date.tzinfo else date.replace(tzinfo=datetime.timezone.utc)
+
+
+def _get_local_events(since: datetime.datetime, until: datetime.datetime) -> Iterator[ReplayedEvent]:
+    for webhook_event in (
+        StripeWebhookEvent.objects.filter(
+            Q(status__in=[StripeWebhookEvent.PENDING, StripeWebhookEvent.FAILED]) | get_stale_processing_filter(),
+            received_at__gte=since,
+            received_at__lte=until,
+        )
+        .order_by("received_at")
+        .iterator()
+    ):
+        event: Dict = json.loads(webhook_event.payload)
+        event.setdefault("created", int(webhook_event.received_at.timestamp()))
+        yield (event, webhook_event.pk)
+
+
+def _get_stripe_events(since: datetime.datetime, until: datetime.datetime) -> Iterator[ReplayedEvent]:
+    events: List[Dict] = list(list_events(since=since, until=until, types=get_handled_event_types()))
+
+    for event in reversed(events):  # Stripe returns the newest events first
+        yield (event, None)
+
+
+def _store_event(event: Dict) -> Optional[int]:
+    webhook_event: Optional[StripeWebhookEvent] = ingest_stripe_webhook_event(event, json.dumps(event))
+    return webhook_event.pk if webhook_event else None  # `None` if it was already processed
+
+
+def _group_by_customer(events: List[ReplayedEvent]) -> List[List[ReplayedEvent]]:
+    groups: Dict[str, List[ReplayedEvent]] = {}
+
+    for event, webhook_event_id in events:
+        groups.setdefault(event["data"]["object"].get("customer", ""), []).append((event, webhook_event_id))
+
+    return list(groups.values())
+
+
+def _process_events(events: List[ReplayedEvent]) -> Dict[str, List[str]]:
+    """
+    Processes stored events in order. Returns the Stripe IDs of the events by result.
+    """
+    results: Dict[str, List[str]] = {"processed": [], "failed": [], "skipped": []}
+
+    for event, webhook_event_id in events:
+        success: Optional[bool] = process_stripe_webhook_event_by_id(webhook_event_id) if webhook_event_id else None
+        results["skipped" if success is None else "processed" if success else "failed"].append(event["id"])
+
+    return results
+
+
+def _process_events_in_thread(events: List[ReplayedEvent]) -> Dict[str, List[str]]:
+    try:
+        return _process_events(events)
+    finally:
+        connection.close()  # each thread opens its own database connection
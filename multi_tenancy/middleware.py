@@ -1,4 +1,6 @@
-from django.contrib.sessions.middleware import SessionMiddleware
+from django.conf import settings
+
+from .utils import get_current_team_snapshot
 
 default_cookie_options = {
     "max_age": 365 * 24 * 60 * 60,  # one year
@@ -12,40 +14,43 @@ default_cookie_options = {
 api_paths = {"e", "s", "capture", "batch", "decide", "api", "track"}
 
 
-class PostHogTokenCookieMiddleware(SessionMiddleware):
+class PostHogTokenCookieMiddleware:
     """
-    Adds two secure cookies to enable auto-filling the current project token on the docs.
+    Adds two secure cookies to enable auto-filling the current project token on the docs. Sessions are handled by
+    Django's `SessionMiddleware`; this middleware only sets the cookies when their values have changed.
     """
 
-    def process_response(self, request, response):
-        response = super().process_response(request, response)
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
 
         # skip adding the cookie on API requests
         split_request_path = request.path.split("/")
         if len(split_request_path) and split_request_path[1] in api_paths:
             return response
 
-        if request.user and request.user.is_authenticated and request.user.team:
-            response.set_cookie(
-                key="ph_current_project_token",
-                value=request.user.team.api_token,
-                max_age=365 * 24 * 60 * 60,
-                expires=default_cookie_options["expires"],
-                path=default_cookie_options["path"],
-                domain=default_cookie_options["domain"],
-                secure=default_cookie_options["secure"],
-                samesite=default_cookie_options["samesite"],
-            )
-
-            response.set_cookie(
-                key="ph_current_project_name",  # clarify which project is active (orgs can have multiple projects)
-                value=request.user.team.name.encode('utf-8').decode('latin-1'),
-                max_age=365 * 24 * 60 * 60,
-                expires=default_cookie_options["expires"],
-                path=default_cookie_options["path"],
-                domain=default_cookie_options["domain"],
-                secure=default_cookie_options["secure"],
-                samesite=default_cookie_options["samesite"],
-            )
+        # without a session the user can't be logged in, no need to load the user (or their team)
+        if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+            return response
+
+        user = getattr(request, "user", None)
+        if not user or not user.is_authenticated:
+            return response
+
+        team = get_current_team_snapshot(user)  # cached, no need to load the team
+        if not team:
+            return response
+
+        cookies = {
+            "ph_current_project_token": team["api_token"],
+            # clarify which project is active (orgs can have multiple projects)
+            "ph_current_project_name": team["name"].encode("utf-8").decode("latin-1"),
+        }
+
+        for key, value in cookies.items():
+            if request.COOKIES.get(key) != value:
+                response.set_cookie(key=key, value=value, **default_cookie_options)
 
         return response
@@ -0,0 +1,26 @@
+# Generated by Django 3.0.11 on 2021-05-03 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("posthog", "0085_org_models"),
+        ("multi_tenancy", "0011_help_texts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyTeamUsage",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("date", models.DateField(db_index=True)),
+                ("event_count", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("team", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="posthog.Team")),
+            ],
+            options={"unique_together": {("team", "date")},},
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.0.11 on 2021-05-06 14:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multi_tenancy", "0012_dailyteamusage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organizationbilling",
+            name="stripe_metered_subscription_item_id",
+            field=models.CharField(
+                blank=True,
+                help_text="ID of the (metered) subscription item to which usage is reported. Cached from Stripe and cleared whenever the subscription is updated.",
+                max_length=128,
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.11 on 2021-05-10 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multi_tenancy", "0013_organizationbilling_stripe_metered_subscription_item_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StripeWebhookEvent",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("type", models.CharField(max_length=128)),
+                ("payload", models.TextField(help_text="Raw payload of the event as received from Stripe.")),
+                ("received_at", models.DateTimeField(auto_now_add=True)),
+                ("processed_at", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.0.11 on 2021-05-11 16:03
+
+import json
+
+from django.db import migrations, models
+
+
+def set_stripe_event_ids(apps, schema_editor):
+    StripeWebhookEvent = apps.get_model("multi_tenancy", "StripeWebhookEvent")
+
+    for webhook_event in StripeWebhookEvent.objects.filter(stripe_event_id__isnull=True):
+        webhook_event.stripe_event_id = json.loads(webhook_event.payload).get("id") or f"unknown_{webhook_event.pk}"
+        webhook_event.status = "processed" if webhook_event.processed_at else "pending"
+        webhook_event.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multi_tenancy", "0014_stripewebhookevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stripewebhookevent", name="stripe_event_id", field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name="stripewebhookevent",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("processing", "Processing"),
+                    ("processed", "Processed"),
+                    ("failed", "Failed"),
+                ],
+                default="pending",
+                max_length=16,
+            ),
+        ),
+        migrations.RunPython(set_stripe_event_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="stripewebhookevent",
+            name="stripe_event_id",
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.11 on 2021-05-12 11:27
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # indexes are created concurrently to avoid locking the table
+
+    dependencies = [
+        ("multi_tenancy", "0015_stripewebhookevent_stripe_event_id_status"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="organizationbilling",
+            index=models.Index(
+                condition=models.Q(_negated=True, stripe_customer_id=""),
+                fields=["stripe_customer_id"],
+                name="billing_customer_id_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="organizationbilling",
+            index=models.Index(
+                condition=models.Q(_negated=True, stripe_checkout_session=""),
+                fields=["stripe_checkout_session"],
+                name="billing_checkout_session_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="organizationbilling",
+            index=models.Index(
+                condition=models.Q(_negated=True, stripe_subscription_id=""),
+                fields=["stripe_subscription_id"],
+                name="billing_subscription_id_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.0.11 on 2021-05-17 09:42
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations, models
+
+BACKFILL_SEARCH_TEXT_SQL = """
+UPDATE multi_tenancy_organizationbilling AS billing
+SET search_text = lower(
+    concat_ws(
+        ' ',
+        nullif(organization.name, ''),
+        (
+            SELECT string_agg(posthog_user.email, ' ')
+            FROM posthog_organizationmembership AS membership
+            JOIN posthog_user ON posthog_user.id = membership.user_id
+            WHERE membership.organization_id = billing.organization_id
+        ),
+        nullif(billing.stripe_customer_id, ''),
+        nullif(billing.stripe_checkout_session, ''),
+        nullif(billing.stripe_subscription_item_id, ''),
+        nullif(billing.stripe_subscription_id, '')
+    )
+)
+FROM posthog_organization AS organization
+WHERE organization.id = billing.organization_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # the index is created concurrently to avoid locking the table
+
+    dependencies = [
+        ("multi_tenancy", "0017_billingrun_billingrunitem"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name="organizationbilling",
+            name="search_text",
+            field=models.TextField(
+                blank=True,
+                editable=False,
+                help_text="Lowercase organization name, member emails and Stripe IDs, for indexed (trigram) searches"
+                " in the admin. Kept up to date by `multi_tenancy.signals`.",
+            ),
+        ),
+        migrations.RunSQL(BACKFILL_SEARCH_TEXT_SQL, migrations.RunSQL.noop),
+        AddIndexConcurrently(
+            model_name="organizationbilling",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_text"], name="billing_search_text_trgm_idx", opclasses=["gin_trgm_ops"],
+            ),
+        ),
+    ]
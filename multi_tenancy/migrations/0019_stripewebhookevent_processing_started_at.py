@@ -0,0 +1,18 @@
+# Generated by Django 3.0.11 on 2021-05-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multi_tenancy", "0018_organizationbilling_search_text"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stripewebhookevent",
+            name="processing_started_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
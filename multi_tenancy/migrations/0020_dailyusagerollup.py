@@ -0,0 +1,32 @@
+# Generated by Django 3.0.11 on 2021-05-19 08:37
+
+from django.db import migrations, models
+
+
+def create_rollups_for_rolled_up_days(apps, schema_editor):
+    DailyTeamUsage = apps.get_model("multi_tenancy", "DailyTeamUsage")
+    DailyUsageRollup = apps.get_model("multi_tenancy", "DailyUsageRollup")
+
+    DailyUsageRollup.objects.bulk_create(
+        [DailyUsageRollup(date=date) for date in DailyTeamUsage.objects.values_list("date", flat=True).distinct()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multi_tenancy", "0019_stripewebhookevent_processing_started_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyUsageRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("date", models.DateField(unique=True)),
+                ("rolled_up_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(create_rollups_for_rolled_up_days, migrations.RunPython.noop),
+    ]
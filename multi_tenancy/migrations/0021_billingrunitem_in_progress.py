@@ -0,0 +1,28 @@
+# Generated by Django 3.0.11 on 2021-05-24 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multi_tenancy", "0020_dailyusagerollup"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="billingrunitem",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("in_progress", "In progress"),
+                    ("reported", "Reported"),
+                    ("failed", "Failed"),
+                    ("skipped", "Skipped"),
+                ],
+                default="pending",
+                max_length=16,
+            ),
+        ),
+    ]
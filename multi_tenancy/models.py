@@ -1,11 +1,15 @@
 import datetime
-from typing import List, Optional, Tuple
+import uuid
+from typing import Dict, List, Optional, Tuple
 
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 from ee.models import License
-from posthog.models import Organization, User
+from posthog.models import Organization, Team, User
 
 from .stripe import create_subscription, create_subscription_checkout_session, create_zero_auth
 
@@ -17,6 +21,48 @@ PLANS = {
     "enterprise": License.ENTERPRISE_FEATURES,
 }
 
+PLAN_REGISTRY_VERSION_KEY: str = "plan_registry_version"
+
+# In-process copy of all plans by ID, reloaded whenever the shared version changes (see `get_plan_registry`)
+_plan_registry: Dict[int, Dict] = {}
+_plan_registry_version: Optional[str] = None
+
+
+def get_plan_registry(reload: bool = False) -> Dict[int, Dict]:
+    """
+    Returns the attributes (and features, see `PLANS`) of every plan by plan ID. Plans rarely change, so they are
+    kept in memory by each process and only reloaded when the version shared through the cache is bumped (whenever
+    a plan is saved) or if `reload`. Costs a single cache lookup (no database queries) on each call.
+    """
+    global _plan_registry, _plan_registry_version
+
+    version: Optional[str] = cache.get(PLAN_REGISTRY_VERSION_KEY)
+
+    if version is None:
+        # Version was never set (or was evicted), start a new one so every process reloads
+        cache.add(PLAN_REGISTRY_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(PLAN_REGISTRY_VERSION_KEY)
+
+    if reload or version != _plan_registry_version:
+        _plan_registry = {
+            plan_id: {
+                "key": key,
+                "price_id": price_id,
+                "event_allowance": event_allowance,
+                "features": PLANS.get(key, []),
+            }
+            for plan_id, key, price_id, event_allowance in Plan.objects.values_list(
+                "id", "key", "price_id", "event_allowance",
+            )
+        }
+        _plan_registry_version = version
+
+    return _plan_registry
+
+
+def bump_plan_registry_version() -> None:
+    cache.set(PLAN_REGISTRY_VERSION_KEY, uuid.uuid4().hex, None)
+
 
 class Plan(models.Model):
     """
@@ -56,7 +102,11 @@ class Plan(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        return super().save(*args, **kwargs)
+        result = super().save(*args, **kwargs)
+        # Bumped again on commit, in case another process reloaded the plans before the transaction was committed
+        bump_plan_registry_version()
+        transaction.on_commit(bump_plan_registry_version)
+        return result
 
     def __str__(self) -> str:
         return self.name
@@ -81,6 +131,12 @@ class OrganizationBilling(models.Model):
     stripe_subscription_item_id: models.CharField = models.CharField(
         max_length=128, blank=True,
     )  # DEPRECATED: We will use the subscription ID now as tiered or graduated pricing may have multiple items
+    stripe_metered_subscription_item_id: models.CharField = models.CharField(
+        max_length=128,
+        blank=True,
+        help_text="ID of the (metered) subscription item to which usage is reported. Cached from Stripe and"
+        " cleared whenever the subscription is updated.",
+    )
     checkout_session_created_at: models.DateTimeField = models.DateTimeField(
         null=True, blank=True,
     )
@@ -96,11 +152,51 @@ class OrganizationBilling(models.Model):
     plan: models.ForeignKey = models.ForeignKey(
         Plan, on_delete=models.PROTECT, null=True, default=None, blank=True,
     )
+    search_text: models.TextField = models.TextField(
+        blank=True,
+        editable=False,
+        help_text="Lowercase organization name, member emails and Stripe IDs, for indexed (trigram) searches in the"
+        " admin. Kept up to date by `multi_tenancy.signals`.",
+    )
+
+    class Meta:
+        # Stripe IDs are looked up when handling webhooks & checkout; most organizations don't have them set
+        indexes = [
+            models.Index(
+                fields=["stripe_customer_id"], name="billing_customer_id_idx", condition=~Q(stripe_customer_id=""),
+            ),
+            models.Index(
+                fields=["stripe_checkout_session"],
+                name="billing_checkout_session_idx",
+                condition=~Q(stripe_checkout_session=""),
+            ),
+            models.Index(
+                fields=["stripe_subscription_id"],
+                name="billing_subscription_id_idx",
+                condition=~Q(stripe_subscription_id=""),
+            ),
+            GinIndex(fields=["search_text"], name="billing_search_text_trgm_idx", opclasses=["gin_trgm_ops"]),
+        ]
+
+    def _get_plan_attributes(self) -> Optional[Dict]:
+        """
+        Returns the attributes of the plan from the plan registry, so the plan doesn't have to be loaded.
+        """
+        if not self.plan_id:
+            return None
+
+        plan_attributes: Optional[Dict] = get_plan_registry().get(self.plan_id)
+
+        if plan_attributes is None:
+            # e.g. the plan was created by another process and the new version isn't visible to this one yet
+            plan_attributes = get_plan_registry(reload=True).get(self.plan_id)
+
+        return plan_attributes
 
     @property
     def is_billing_active(self) -> bool:
         return bool(
-            self.plan
+            self.plan_id
             and not self.should_setup_billing
             and self.billing_period_ends
             and self.billing_period_ends > timezone.now()
@@ -113,10 +209,12 @@ class OrganizationBilling(models.Model):
         """
         if only_active and not self.is_billing_active:
             return None
-        return self.plan.key if self.plan else None
+        plan_attributes: Optional[Dict] = self._get_plan_attributes()
+        return plan_attributes["key"] if plan_attributes else None
 
     def get_price_id(self) -> str:
-        return self.plan.price_id if self.plan else ""
+        plan_attributes: Optional[Dict] = self._get_plan_attributes()
+        return plan_attributes["price_id"] if plan_attributes else ""
 
     @property
     def event_allocation(self) -> Optional[int]:
@@ -126,16 +224,52 @@ class OrganizationBilling(models.Model):
         if not self.is_billing_active:
             # No active billing plan, default to event allocation for when no billing plan is active
             return settings.BILLING_NO_PLAN_EVENT_ALLOCATION
-        return self.plan.event_allowance
+        plan_attributes: Optional[Dict] = self._get_plan_attributes()
+        return plan_attributes["event_allowance"] if plan_attributes else None
 
     @property
     def available_features(self) -> List[str]:
-        plan_key = self.get_plan_key()
+        if not self.is_billing_active:
+            return []
+        plan_attributes: Optional[Dict] = self._get_plan_attributes()
+        return plan_attributes["features"] if plan_attributes else []
+
+    @property
+    def active_checkout_session(self) -> Optional[str]:
+        """
+        Returns the checkout session if it has been created and is still active (i.e. created less than 24 hours ago).
+        """
+        if (
+            self.stripe_checkout_session
+            and self.checkout_session_created_at
+            and self.checkout_session_created_at + timezone.timedelta(minutes=1439) > timezone.now()
+        ):
+            return self.stripe_checkout_session
+        return None
+
+    def get_or_create_checkout_session(self, user: User, base_url: str) -> Optional[str]:
+        """
+        Returns the active checkout session or creates a new one. The billing row is locked while the session is
+        created, so concurrent requests (e.g. multiple tabs) for the same organization create a single session.
+        """
+        with transaction.atomic():
+            instance = OrganizationBilling.objects.select_for_update().get(pk=self.pk)
+
+            if instance.active_checkout_session:
+                # Created by a concurrent request while waiting for the lock
+                return instance.active_checkout_session
 
-        if plan_key and plan_key in PLANS:
-            return PLANS[plan_key]
+            (checkout_session, customer_id) = instance.create_checkout_session(user=user, base_url=base_url)
 
-        return []
+            if checkout_session:
+                OrganizationBilling.objects.filter(pk=instance.pk).update(
+                    stripe_checkout_session=checkout_session,
+                    stripe_customer_id=customer_id,
+                    checkout_session_created_at=timezone.now(),
+                )
+                update_billing_search_text([instance.pk])
+
+        return checkout_session
 
     def create_checkout_session(self, user: User, base_url: str,) -> Tuple[Optional[str], Optional[str]]:
         """
@@ -155,15 +289,142 @@ class OrganizationBilling(models.Model):
 
     def handle_post_card_validation(self) -> "OrganizationBilling":
         """
-        Handles logic after a card has been validated.
+        Handles logic after a card has been validated. Webhooks may be processed more than once, so a metered
+        subscription is only created if there's none yet.
         """
         if self.plan.key == "startup":
             self.billing_period_ends = timezone.now() + datetime.timedelta(days=365)
             self.should_setup_billing = False
         elif self.plan.is_metered_billing:
+            if self.stripe_subscription_id:
+                return self
+
             subscription = create_subscription(price_id=self.plan.price_id, customer_id=self.stripe_customer_id)
             self.stripe_subscription_item_id = subscription["subscription_item_id"]
+            self.stripe_metered_subscription_item_id = subscription[
+                "subscription_item_id"
+            ]  # subscription is created with a single (metered) price
             self.stripe_subscription_id = subscription["subscription_id"]
             self.should_setup_billing = False
         self.save()
         return self
+
+
+def update_billing_search_text(organization_ids: List) -> None:
+    """
+    Recomputes `OrganizationBilling.search_text` for the billing of the organizations provided.
+    """
+
+    for instance in OrganizationBilling.objects.filter(organization_id__in=organization_ids).select_related(
+        "organization",
+    ):
+        search_text: str = " ".join(
+            value
+            for value in [
+                instance.organization.name,
+                *instance.organization.members.values_list("email", flat=True),
+                instance.stripe_customer_id,
+                instance.stripe_checkout_session,
+                instance.stripe_subscription_item_id,
+                instance.stripe_subscription_id,
+            ]
+            if value
+        ).lower()
+        OrganizationBilling.objects.filter(pk=instance.pk).update(search_text=search_text)
+
+
+class DailyTeamUsage(models.Model):
+    """
+    Pre-aggregated number of events ingested by a team on a given day (UTC). Filled by the
+    `rollup_daily_team_usage` task so that billing reads don't have to count raw events.
+    """
+
+    team: models.ForeignKey = models.ForeignKey(Team, on_delete=models.CASCADE)
+    date: models.DateField = models.DateField(db_index=True)
+    event_count: models.BigIntegerField = models.BigIntegerField(default=0)
+    updated_at: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("team", "date")
+
+
+class DailyUsageRollup(models.Model):
+    """
+    Day that has been rolled up into `DailyTeamUsage` (for every team; teams without events that day have no row).
+    Usage of days that haven't been rolled up (e.g. before the first rollup) is counted from raw events.
+    """
+
+    date: models.DateField = models.DateField(unique=True)
+    rolled_up_at: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+
+class StripeWebhookEvent(models.Model):
+    """
+    Stripe webhook event as received (after verifying its signature). Events are stored by the webhook view and
+    processed asynchronously by the `process_stripe_webhook_event` task. Stripe may deliver the same event multiple
+    times, so events are deduplicated by their Stripe ID.
+    """
+
+    PENDING = "pending"
+    PROCESSING = "processing"
+    PROCESSED = "processed"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (PROCESSING, "Processing"),
+        (PROCESSED, "Processed"),
+        (FAILED, "Failed"),
+    ]
+
+    stripe_event_id: models.CharField = models.CharField(max_length=255, unique=True)
+    type: models.CharField = models.CharField(max_length=128)
+    payload: models.TextField = models.TextField(help_text="Raw payload of the event as received from Stripe.")
+    status: models.CharField = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    received_at: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    processing_started_at: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+    processed_at: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+
+
+class BillingRun(models.Model):
+    """
+    Nightly report of the metered usage of a day to Stripe (see `tasks.compute_daily_usage_for_organizations`). The
+    status of each organization is tracked in `BillingRunItem`, so a run can be resumed without reporting again for
+    organizations that have already been reported.
+    """
+
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (RUNNING, "Running"),
+        (COMPLETED, "Completed"),
+        (FAILED, "Completed with failures"),
+    ]
+
+    for_date: models.DateField = models.DateField(unique=True)
+    status: models.CharField = models.CharField(max_length=16, choices=STATUS_CHOICES, default=RUNNING)
+    created_at: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+    finished_at: models.DateTimeField = models.DateTimeField(null=True, blank=True)
+
+
+class BillingRunItem(models.Model):
+    PENDING = "pending"
+    IN_PROGRESS = "in_progress"
+    REPORTED = "reported"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (IN_PROGRESS, "In progress"),
+        (REPORTED, "Reported"),
+        (FAILED, "Failed"),
+        (SKIPPED, "Skipped"),
+    ]
+
+    billing_run: models.ForeignKey = models.ForeignKey(BillingRun, on_delete=models.CASCADE, related_name="items")
+    organization_billing: models.ForeignKey = models.ForeignKey(OrganizationBilling, on_delete=models.CASCADE)
+    status: models.CharField = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    updated_at: models.DateTimeField = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("billing_run", "organization_billing")
@@ -1,3 +1,4 @@
+import datetime
 from decimal import Decimal
 from typing import Any, Dict, Optional
 
@@ -9,10 +10,8 @@ from posthog.models import User
 from rest_framework import serializers
 from sentry_sdk import capture_exception
 
-from multi_tenancy.stripe import get_current_usage_bill
-
 from .models import OrganizationBilling, Plan
-from .utils import get_cached_monthly_event_usage
+from .utils import get_cached_current_usage_bill, get_cached_monthly_event_usage
 
 
 class ReadOnlySerializer(serializers.ModelSerializer):
@@ -95,32 +94,15 @@ class BillingSerializer(serializers.ModelSerializer):
         return None
 
     def get_subscription_url(self, instance: OrganizationBilling) -> Optional[str]:
-        request = self.context["request"]
-        checkout_session = None
-        if instance.should_setup_billing and not instance.is_billing_active:
-            if (
-                instance.stripe_checkout_session
-                and instance.checkout_session_created_at
-                and instance.checkout_session_created_at + timezone.timedelta(minutes=1439) > timezone.now()
-            ):
-                # Checkout session has been created and is still active (i.e. created less than 24 hours ago)
-                checkout_session = instance.stripe_checkout_session
-            else:
-                try:
-                    (checkout_session, customer_id) = instance.create_checkout_session(
-                        user=request.user, base_url=request.build_absolute_uri("/"),
-                    )
-                except ImproperlyConfigured as e:
-                    capture_exception(e)
-                else:
-                    if checkout_session:
-                        OrganizationBilling.objects.filter(pk=instance.pk).update(
-                            stripe_checkout_session=checkout_session,
-                            stripe_customer_id=customer_id,
-                            checkout_session_created_at=timezone.now(),
-                        )
-
-        return f"/billing/setup?session_id={checkout_session}" if checkout_session else None
+        """
+        Returns the URL to set up billing. If there's no active checkout session, it is created when the URL is
+        visited (see `stripe_checkout_view`), so reading billing information never calls Stripe.
+        """
+        if not instance.should_setup_billing or instance.is_billing_active:
+            return None
+
+        checkout_session: Optional[str] = instance.active_checkout_session
+        return f"/billing/setup?session_id={checkout_session}" if checkout_session else "/billing/setup"
 
     def get_should_display_current_bill(self, instance: OrganizationBilling) -> bool:
         if instance.is_billing_active and instance.plan.is_metered_billing:
@@ -134,7 +116,7 @@ class BillingSerializer(serializers.ModelSerializer):
         """
         if not instance.is_billing_active or not instance.plan.is_metered_billing:
             return None
-        return get_current_usage_bill(instance.stripe_subscription_id)
+        return get_cached_current_usage_bill(instance.stripe_subscription_id)
 
 
 class BillingSubscribeSerializer(serializers.Serializer):
@@ -185,3 +167,27 @@ class BillingSubscribeSerializer(serializers.Serializer):
 
     def to_representation(self, instance):
         return instance
+
+
+class BillingUsageSerializer(serializers.Serializer):
+    """
+    Validates the date range of the per-team event usage breakdown. Defaults to the current calendar month.
+    """
+
+    MAX_DAYS: int = 366
+
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+
+    def validate(self, attrs: Dict[str, Any]) -> Dict[str, Any]:
+        today: datetime.date = timezone.now().date()
+        attrs["date_to"] = attrs.get("date_to") or today
+        attrs["date_from"] = attrs.get("date_from") or attrs["date_to"].replace(day=1)
+
+        if attrs["date_from"] > attrs["date_to"]:
+            raise serializers.ValidationError("`date_from` must be before `date_to`.")
+
+        if (attrs["date_to"] - attrs["date_from"]).days >= self.MAX_DAYS:
+            raise serializers.ValidationError(f"Usage can be requested for up to {self.MAX_DAYS} days at a time.")
+
+        return attrs
@@ -0,0 +1,56 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from posthog.models import Organization, OrganizationMembership, Team, User
+
+from .models import OrganizationBilling, update_billing_search_text
+from .utils import invalidate_current_team_snapshots
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_current_team(sender, instance: User, **kwargs) -> None:
+    # The user may have switched teams (or organizations)
+    invalidate_current_team_snapshots([instance.id])
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def invalidate_team_members_current_team(sender, instance: Team, **kwargs) -> None:
+    # The team may have been renamed (or its token reset); any member of the organization may have it as current team
+    invalidate_current_team_snapshots(list(instance.organization.members.values_list("id", flat=True)))
+
+
+@receiver(post_save, sender=OrganizationBilling)
+def update_search_text_on_billing_change(sender, instance: OrganizationBilling, **kwargs) -> None:
+    update_billing_search_text([instance.organization_id])
+
+
+@receiver(post_save, sender=Organization)
+def update_search_text_on_organization_change(sender, instance: Organization, **kwargs) -> None:
+    update_billing_search_text([instance.id])
+
+
+@receiver(post_save, sender=OrganizationMembership)
+@receiver(post_delete, sender=OrganizationMembership)
+def update_search_text_on_membership_change(sender, instance: OrganizationMembership, **kwargs) -> None:
+    update_billing_search_text([instance.organization_id])
+
+
+@receiver(pre_save, sender=User)
+def track_user_email_change(sender, instance: User, update_fields=None, **kwargs) -> None:
+    # Users are saved often (e.g. on every login), only the email is relevant for the search text
+    if update_fields is not None:
+        instance._email_changed = "email" in update_fields
+    else:
+        instance._email_changed = (
+            not instance._state.adding and not User.objects.filter(pk=instance.pk, email=instance.email).exists()
+        )
+
+
+@receiver(post_save, sender=User)
+def update_search_text_on_user_change(sender, instance: User, **kwargs) -> None:
+    if not getattr(instance, "_email_changed", False):
+        return
+
+    update_billing_search_text(
+        list(OrganizationMembership.objects.filter(user=instance).values_list("organization_id", flat=True)),
+    )
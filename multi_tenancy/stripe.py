@@ -1,38 +1,111 @@
 import datetime
 import logging
+import random
+import time
 from decimal import Decimal
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
-from sentry_sdk.api import capture_exception
 
 import stripe
-from multi_tenancy.utils import get_billing_cycle_anchor
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+STRIPE_MAX_BACKOFF: int = 30  # seconds
+STRIPE_WEB_MAX_BACKOFF: int = 1  # seconds, requests that don't retry on rate limits (e.g. from web requests) fail fast
+
 
 def _init_stripe() -> None:
     if not settings.STRIPE_API_KEY:
         raise ImproperlyConfigured("Cannot process billing because env vars are not properly set.")
 
     stripe.api_key = settings.STRIPE_API_KEY
+    stripe.max_network_retries = settings.STRIPE_MAX_RETRIES  # connection errors & conflicts are retried by Stripe
+
+
+def _wait_for_rate_limit(block: bool = True) -> None:
+    """
+    Blocks until a request can be made to Stripe without exceeding `STRIPE_MAX_REQUESTS_PER_SECOND`. The budget is
+    shared by all workers through the cache and refilled every second. If not `block`, waits at most for the next
+    window (under a second) and proceeds anyway; Stripe will rate limit the request if needed.
+    """
+    waited: bool = False
+
+    while True:
+        window: int = int(time.time())
+        key: str = f"stripe_requests_{window}"
+        cache.add(key, 0, 2)
+
+        try:
+            count: int = cache.incr(key)
+        except ValueError:
+            continue  # window expired in the meantime
+
+        if count <= settings.STRIPE_MAX_REQUESTS_PER_SECOND or (waited and not block):
+            return
+
+        time.sleep(max(window + 1 - time.time(), 0))
+        waited = True
+
+
+def _get_backoff_seconds(error: stripe.error.StripeError, attempt: int, max_backoff: float) -> float:
+    retry_after: Optional[str] = (error.headers or {}).get("Retry-After")
+
+    if retry_after:
+        try:
+            return min(float(retry_after), max_backoff)
+        except ValueError:
+            pass
+
+    # Exponential backoff with jitter
+    return min(0.5 * 2 ** attempt, max_backoff) * random.uniform(0.75, 1.25)
+
+
+def _request(method: Callable[..., T], *args, retry_on_rate_limit: bool = False, **kwargs) -> T:
+    """
+    Makes a request to Stripe respecting our own rate limit. If Stripe still rate limits the request (HTTP 429), we
+    back off (using `Retry-After` when provided) and retry.
+
+    Only background tasks should pass `retry_on_rate_limit`, which waits for our own rate limit and retries up to
+    `STRIPE_MAX_RETRIES` times (possibly for minutes). Otherwise (e.g. web requests) we fail fast: the request is
+    retried at most once after a short backoff.
+    """
+    attempt: int = 0
+    max_retries: int = settings.STRIPE_MAX_RETRIES if retry_on_rate_limit else 1
+    max_backoff: float = STRIPE_MAX_BACKOFF if retry_on_rate_limit else STRIPE_WEB_MAX_BACKOFF
+
+    while True:
+        _wait_for_rate_limit(block=retry_on_rate_limit)
+
+        try:
+            return method(*args, **kwargs)
+        except stripe.error.RateLimitError as e:
+            if attempt >= max_retries:
+                raise
+
+            backoff: float = _get_backoff_seconds(e, attempt, max_backoff)
+            logger.warning(f"Rate limited by Stripe, retrying in {backoff:.2f} seconds.")
+            time.sleep(backoff)
+            attempt += 1
 
 
 def _get_customer_id(customer_id: str, email: str = "") -> str:
     _init_stripe()
     if customer_id:
         return customer_id
-    return stripe.Customer.create(email=email).id
+    return _request(stripe.Customer.create, email=email).id
 
 
 def set_default_payment_method_for_customer(customer_id: str, payment_method_id: str) -> bool:
     _init_stripe()
     return (
-        stripe.Customer.modify(
-            customer_id, invoice_settings={"default_payment_method": payment_method_id}
+        _request(
+            stripe.Customer.modify, customer_id, invoice_settings={"default_payment_method": payment_method_id}
         ).invoice_settings.default_payment_method
         == payment_method_id
     )
@@ -61,7 +134,7 @@ def create_subscription_checkout_session(
         logger.info(f"Simulating Stripe checkout session: {payload}")
         return ("cs_1234567890", customer_id)
 
-    session = stripe.checkout.Session.create(**payload)
+    session = _request(stripe.checkout.Session.create, **payload)
 
     return (session.id, customer_id)
 
@@ -84,7 +157,7 @@ def create_zero_auth(email: str, base_url: str, customer_id: str = "") -> Tuple[
         "cancel_url": base_url + "billing/failed?session_id={CHECKOUT_SESSION_ID}",
     }
 
-    session = stripe.checkout.Session.create(**payload)
+    session = _request(stripe.checkout.Session.create, **payload)
 
     return (session.id, customer_id)
 
@@ -94,16 +167,19 @@ def create_subscription(price_id: str = "", customer_id: str = "",) -> Dict[str,
     Creates a subscription for an existing customer with payment details already set up. Used mainly for metered
     plans.
     """
+    from multi_tenancy.utils import get_billing_cycle_anchor  # local import as `utils` depends on the models
 
     customer_id = _get_customer_id(
         customer_id
     )  # we don't pass the email because the customer is always created before (on zero auth)
 
-    subscription = stripe.Subscription.create(
+    subscription = _request(
+        stripe.Subscription.create,
         customer=customer_id,
         items=[{"price": price_id}],
         trial_period_days=settings.BILLING_TRIAL_DAYS,
         billing_cycle_anchor=get_billing_cycle_anchor(timezone.now()),
+        idempotency_key=f"{customer_id}-{price_id}",  # retried webhooks must not create a second subscription
     )
 
     subscription_data = subscription.to_dict()
@@ -117,7 +193,7 @@ def create_subscription(price_id: str = "", customer_id: str = "",) -> Dict[str,
 
 def cancel_payment_intent(payment_intent_id: str) -> None:
     _init_stripe()
-    stripe.PaymentIntent.cancel(payment_intent_id)
+    _request(stripe.PaymentIntent.cancel, payment_intent_id)
 
 
 def customer_portal_url(customer_id: str) -> Optional[str]:
@@ -127,7 +203,7 @@ def customer_portal_url(customer_id: str) -> Optional[str]:
     if settings.TEST:
         return f"/manage-my-billing/{customer_id}"
 
-    return stripe.billing_portal.Session.create(customer=customer_id).url
+    return _request(stripe.billing_portal.Session.create, customer=customer_id).url
 
 
 def parse_webhook(payload: Union[bytes, str], signature: str) -> Dict:
@@ -142,43 +218,77 @@ def compute_webhook_signature(payload: str, secret: str) -> str:
     return stripe.webhook.WebhookSignature._compute_signature(payload, secret)
 
 
-def report_subscription_item_usage(subscription_id: str, billed_usage: int, timestamp: datetime.datetime,) -> bool:
-    _init_stripe()
-
-    subscription = get_subscription(subscription_id)
+def get_metered_subscription_item_id(subscription: Dict[str, Any]) -> Optional[str]:
+    """
+    Returns the ID of the subscription item to which usage should be reported. If a subscription has multiple items,
+    the one with metered usage is picked.
+    """
     subscription_items = subscription.get("items", {}).get("data", [])
     subscription_item_id = None
     for item in subscription_items:
         # if we have multiple items in a subscription, pick one that is metered usage.
         if subscription_item_id is None or item.get("price").get("recurring").get("usage_type") == "metered":
             subscription_item_id = item.get("id")
+    return subscription_item_id
+
+
+def report_subscription_item_usage(
+    subscription_id: str,
+    billed_usage: int,
+    timestamp: datetime.datetime,
+    subscription_item_id: str = "",
+    retry_on_rate_limit: bool = False,
+) -> bool:
+    """
+    Reports usage for the subscription. If the (metered) subscription item is known it should be passed to avoid
+    retrieving the subscription from Stripe.
+    """
+    _init_stripe()
+
+    if not subscription_item_id:
+        subscription_item_id = get_metered_subscription_item_id(
+            get_subscription(subscription_id, retry_on_rate_limit=retry_on_rate_limit),
+        )
 
     # The idempotency_key is the combination of the subscription ID and current timestamp, as we should only report
     # usage once per day, this should ensure no events are doubled counted
-    usage_record = stripe.SubscriptionItem.create_usage_record(
+    usage_record = _request(
+        stripe.SubscriptionItem.create_usage_record,
         subscription_item_id,
         quantity=billed_usage,
         timestamp=timezone.now(),
         idempotency_key=f"{subscription_item_id}-{timestamp.strftime('%Y-%m-%d')}",
+        retry_on_rate_limit=retry_on_rate_limit,
     )
     return bool(usage_record.id)
 
 
-def get_subscription(subscription_id: str) -> Dict[str, Any]:
+def get_subscription(subscription_id: str, retry_on_rate_limit: bool = False) -> Dict[str, Any]:
+    _init_stripe()
+    return _request(stripe.Subscription.retrieve, subscription_id, retry_on_rate_limit=retry_on_rate_limit)
+
+
+def list_events(since: datetime.datetime, until: datetime.datetime, types: List[str]) -> Iterator[Dict[str, Any]]:
+    """
+    Iterates over the events created on Stripe in a time window (newest first), fetching them page by page. Only
+    used from management commands, so rate limited requests are retried.
+    """
     _init_stripe()
-    return stripe.Subscription.retrieve(subscription_id)
+    return _request(
+        stripe.Event.list,
+        created={"gte": int(since.timestamp()), "lte": int(until.timestamp())},
+        types=types,
+        limit=100,
+        retry_on_rate_limit=True,
+    ).auto_paging_iter()
 
 
-def get_current_usage_bill(subscription_id: str) -> Optional[Decimal]:
+def get_current_usage_bill(subscription_id: str, retry_on_rate_limit: bool = False) -> Optional[Decimal]:
     """
     Obtains the upcoming invoice (not billed yet) for the relevant subscription and parses the
-    zero-decimal amount.
+    zero-decimal amount. Makes a request to Stripe every time, use `utils.get_cached_current_usage_bill` instead.
     """
     _init_stripe()
 
-    try:
-        invoice = stripe.Invoice.upcoming(subscription=subscription_id)
-        return Decimal(invoice["amount_due"] / 100) if invoice.get("amount_due") else None
-    except Exception as e:
-        capture_exception(e)
-        return None
+    invoice = _request(stripe.Invoice.upcoming, subscription=subscription_id, retry_on_rate_limit=retry_on_rate_limit)
+    return Decimal(invoice["amount_due"] / 100) if invoice.get("amount_due") else None
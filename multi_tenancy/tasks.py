@@ -1,35 +1,161 @@
 import datetime
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 
 import dateutil
 import posthoganalytics
 import pytz
+from celery import group
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from posthog.celery import app
-from posthog.models import Organization
-from sentry_sdk import capture_message
+from posthog.models import Organization, Team
+from sentry_sdk import capture_exception, capture_message
 
-from multi_tenancy.stripe import get_subscription, report_subscription_item_usage
-from multi_tenancy.utils import get_event_usage_for_timerange
+from multi_tenancy.stripe import get_metered_subscription_item_id, get_subscription, report_subscription_item_usage
+from multi_tenancy.utils import (
+    cache_event_quotas_for_organizations,
+    get_last_rolled_up_date,
+    get_organizations_event_usage_for_timerange,
+    get_teams_event_usage_for_timerange,
+    invalidate_cached_current_usage_bills,
+    refresh_current_usage_bill,
+    refresh_monthly_event_usage,
+    release_current_usage_bill_refresh_lock,
+    release_monthly_event_usage_refresh_lock,
+)
 
-from .models import OrganizationBilling
+from .models import BillingRun, BillingRunItem, DailyTeamUsage, DailyUsageRollup, OrganizationBilling
+
+ROLLUP_RECOUNT_DAYS: int = 2  # days rolled up again on every run, to include events ingested late
+BILLING_RUN_ITEM_PROCESSING_TIMEOUT = datetime.timedelta(hours=1)
 
 
 def compute_daily_usage_for_organizations(for_date: Optional[datetime.datetime] = None,) -> None:
     """
-    Creates a separate async task to calculate the daily usage for each organization the day before.
+    Reports the daily usage of every metered organization the day before (or on `for_date`) to Stripe as a billing
+    run. Organizations are split in chunks (see `BILLING_USAGE_CHUNK_SIZE`) which are dispatched together as a Celery
+    group. Running again for the same date resumes the run: only organizations that haven't been reported yet (or
+    whose report failed) are dispatched again. Organizations whose chunk is still queued or running are left alone
+    unless they've been in progress for longer than `BILLING_RUN_ITEM_PROCESSING_TIMEOUT` (e.g. the worker died).
     """
 
-    for instance in OrganizationBilling.objects.filter(plan__is_metered_billing=True).exclude(
-        stripe_subscription_id=""
-    ):
-        _compute_daily_usage_for_organization.delay(
-            organization_billing_pk=str(instance.pk), for_date=for_date,
+    target_date: datetime.date = (for_date or timezone.now() - datetime.timedelta(days=1)).date()
+    billing_run, created = BillingRun.objects.get_or_create(for_date=target_date)
+
+    if not created:
+        BillingRun.objects.filter(pk=billing_run.pk).update(status=BillingRun.RUNNING, finished_at=None)
+
+    # Organizations that started a metered subscription since the run was created are added to it
+    BillingRunItem.objects.bulk_create(
+        [
+            BillingRunItem(billing_run=billing_run, organization_billing_id=pk)
+            for pk in OrganizationBilling.objects.filter(plan__is_metered_billing=True)
+            .exclude(stripe_subscription_id="")
+            .values_list("pk", flat=True)
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+    chunk_size: int = settings.BILLING_USAGE_CHUNK_SIZE
+    resumable_filter: Q = Q(status__in=[BillingRunItem.PENDING, BillingRunItem.FAILED]) | Q(
+        status=BillingRunItem.IN_PROGRESS, updated_at__lt=timezone.now() - BILLING_RUN_ITEM_PROCESSING_TIMEOUT,
+    )
+    organization_billing_pks: List[str] = [
+        str(pk)
+        for pk in BillingRunItem.objects.filter(resumable_filter, billing_run=billing_run)
+        .order_by("organization_billing_id")
+        .values_list("organization_billing_id", flat=True)
+    ]
+
+    if not organization_billing_pks:
+        _finish_billing_run(billing_run.pk)
+        return
+
+    # Failed (and stale) organizations are pending again, so the run isn't finished before all of them have been
+    # reported again and so they can be claimed by the chunks dispatched below
+    _update_billing_run_items(
+        billing_run.pk,
+        BillingRunItem.PENDING,
+        resumable_filter,
+        organization_billing_id__in=organization_billing_pks,
+    )
+
+    group(
+        _compute_daily_usage_for_organizations.si(
+            organization_billing_pks=organization_billing_pks[i : i + chunk_size],
+            for_date=target_date.isoformat(),
+            billing_run_id=billing_run.pk,
+        )
+        for i in range(0, len(organization_billing_pks), chunk_size)
+    ).apply_async()
+
+
+def _update_billing_run_items(billing_run_id: Optional[int], status: str, *args, **filters) -> None:
+    if billing_run_id:
+        BillingRunItem.objects.filter(*args, billing_run_id=billing_run_id, **filters).update(
+            status=status, updated_at=timezone.now(),  # `auto_now` is not applied by `update()`
         )
 
 
+def _claim_billing_run_items(billing_run_id: Optional[int], organization_billing_pks: List[str]) -> List[str]:
+    """
+    Marks the pending organizations of a chunk as in progress and returns them. Organizations that are no longer
+    pending (e.g. claimed by a chunk dispatched again when the run was resumed) are left out, so their usage is never
+    reported twice.
+    """
+
+    if not billing_run_id:
+        return organization_billing_pks
+
+    with transaction.atomic():
+        claimed_pks: Set[str] = {
+            str(pk)
+            for pk in BillingRunItem.objects.select_for_update()
+            .filter(
+                billing_run_id=billing_run_id,
+                organization_billing_id__in=organization_billing_pks,
+                status=BillingRunItem.PENDING,
+            )
+            .values_list("organization_billing_id", flat=True)
+        }
+        _update_billing_run_items(billing_run_id, BillingRunItem.IN_PROGRESS, organization_billing_id__in=claimed_pks)
+
+    return [pk for pk in organization_billing_pks if pk in claimed_pks]
+
+
+def _finish_billing_run(billing_run_id: Optional[int]) -> None:
+    """
+    Marks a billing run as finished once none of its organizations are pending or in progress. Reports that failed may
+    still succeed when retried (or when the run is resumed), in which case the run is marked as completed.
+    """
+
+    if not billing_run_id:
+        return
+
+    items = BillingRunItem.objects.filter(billing_run_id=billing_run_id)
+
+    if items.filter(status__in=[BillingRunItem.PENDING, BillingRunItem.IN_PROGRESS]).exists():
+        return
+
+    BillingRun.objects.filter(pk=billing_run_id).update(
+        status=BillingRun.FAILED if items.filter(status=BillingRunItem.FAILED).exists() else BillingRun.COMPLETED,
+        finished_at=timezone.now(),
+    )
+
+
 @app.task(bind=True, ignore_result=True, max_retries=3)
-def _compute_daily_usage_for_organization(self, organization_billing_pk: str, for_date: Optional[str]) -> None:
+def _compute_daily_usage_for_organizations(
+    self, organization_billing_pks: List[str], for_date: Optional[str], billing_run_id: Optional[int] = None,
+) -> None:
+    """
+    Calculates the daily usage for a chunk of organizations with a single grouped query and schedules the report of
+    each organization's usage to Stripe. Only organizations this chunk manages to claim in the billing run (if any)
+    are reported.
+    """
 
     target_date = (
         dateutil.parser.parse(for_date)
@@ -37,63 +163,316 @@ def _compute_daily_usage_for_organization(self, organization_billing_pk: str, fo
         else timezone.now() - datetime.timedelta(days=1)  # by default we do the day before
     )
 
-    instance = OrganizationBilling.objects.get(pk=organization_billing_pk)
     start_time = datetime.datetime.combine(target_date, datetime.time.min)
     end_time = datetime.datetime.combine(target_date, datetime.time.max)
-    event_usage = get_event_usage_for_timerange(
-        organization=instance.organization, start_time=start_time, end_time=end_time
+    event_usage = get_organizations_event_usage_for_timerange(
+        organization_ids=organization_billing_pks, start_time=start_time, end_time=end_time
     )
 
     if event_usage is None:
         # Clickhouse not available, retry
         raise self.retry()
 
-    report_monthly_usage.delay(
-        subscription_id=instance.stripe_subscription_id, billed_usage=event_usage, for_date=start_time,
+    # Claimed only once usage has been computed, so a retry above can still claim the chunk
+    organization_billing_pks = _claim_billing_run_items(billing_run_id, organization_billing_pks)
+
+    if not organization_billing_pks:
+        return
+
+    subscriptions: Dict[str, Tuple[str, str]] = {
+        str(pk): (subscription_id, subscription_item_id)
+        for pk, subscription_id, subscription_item_id in OrganizationBilling.objects.filter(
+            pk__in=organization_billing_pks,
+        )
+        .exclude(stripe_subscription_id="")
+        .values_list("pk", "stripe_subscription_id", "stripe_metered_subscription_item_id")
+    }
+
+    usage_reports: List[Tuple[str, int, str, str]] = [
+        (subscriptions[pk][0], event_usage[pk], start_time, subscriptions[pk][1])
+        for pk in organization_billing_pks
+        if pk in subscriptions  # subscription may have been removed after the chunk was dispatched
+    ]
+
+    _update_billing_run_items(
+        billing_run_id,
+        BillingRunItem.SKIPPED,
+        organization_billing_id__in=[pk for pk in organization_billing_pks if pk not in subscriptions],
     )
 
+    if usage_reports:
+        report_monthly_usage_batch.delay(usage_reports=usage_reports, billing_run_id=billing_run_id)
+    else:
+        _finish_billing_run(billing_run_id)
+
 
 @app.task(bind=True, ignore_result=True, max_retries=3)
-def report_monthly_usage(self, subscription_id: str, billed_usage: int, for_date: str) -> None:
+def rollup_daily_team_usage(self, for_date: Optional[str] = None) -> None:
+    """
+    Persists the number of events ingested by every team on a day in `DailyTeamUsage`. By default, rolls up every day
+    since the last rollup (or since the start of the current month) until yesterday, in order, to avoid gaps. The
+    last `ROLLUP_RECOUNT_DAYS` days are always rolled up again, so events ingested late are included.
+    """
+
+    yesterday: datetime.date = (timezone.now() - datetime.timedelta(days=1)).date()
+
+    if for_date:
+        date: datetime.date = dateutil.parser.parse(for_date).date()
+        if date > yesterday:
+            raise ValueError("Only days that are over can be rolled up.")
+        dates: List[datetime.date] = [date]
+    else:
+        last_rolled_up_date = get_last_rolled_up_date()
+        next_date: datetime.date = min(
+            last_rolled_up_date + datetime.timedelta(days=1) if last_rolled_up_date else yesterday.replace(day=1),
+            yesterday - datetime.timedelta(days=ROLLUP_RECOUNT_DAYS - 1),
+        )
+        dates = [next_date + datetime.timedelta(days=i) for i in range(0, (yesterday - next_date).days + 1)]
+
+    for date in dates:
+        team_usage = get_teams_event_usage_for_timerange(
+            start_time=datetime.datetime.combine(date, datetime.time.min),
+            end_time=datetime.datetime.combine(date, datetime.time.max),
+        )
+
+        if team_usage is None:
+            # Clickhouse not available, retry (days already rolled up won't be recomputed)
+            raise self.retry()
+
+        # Events may still exist in Clickhouse for teams that have been deleted
+        existing_team_ids = set(Team.objects.filter(id__in=team_usage.keys()).values_list("id", flat=True))
+
+        with transaction.atomic():
+            DailyTeamUsage.objects.filter(date=date).delete()
+            DailyTeamUsage.objects.bulk_create(
+                [
+                    DailyTeamUsage(team_id=team_id, date=date, event_count=event_count)
+                    for team_id, event_count in team_usage.items()
+                    if team_id in existing_team_ids
+                ],
+                batch_size=1000,
+            )
+            DailyUsageRollup.objects.update_or_create(date=date)
+
+
+@app.task(ignore_result=True)
+def refresh_monthly_event_usage_for_organization(organization_id: str) -> None:
+    """
+    Refreshes the cached monthly event usage of an organization in the background and releases the refresh lock
+    acquired by `get_cached_monthly_event_usage`.
+    """
+
+    try:
+        refresh_monthly_event_usage(Organization.objects.get(id=organization_id))
+    finally:
+        release_monthly_event_usage_refresh_lock(organization_id)
 
-    success = report_subscription_item_usage(subscription_id=subscription_id, billed_usage=billed_usage, timestamp=dateutil.parser.parse(for_date),
+
+@app.task(bind=True, ignore_result=True, max_retries=3)
+def refresh_event_quotas(self) -> None:
+    """
+    Precomputes the event quota (allocation, monthly usage & whether it's been exceeded) of every organization, one
+    grouped query per chunk of organizations, so quotas can be enforced at ingestion with a single cache lookup. The
+    monthly event usage cache is warmed with the same results, so the billing page always reads a warm cache.
+    """
+
+    chunk_size: int = settings.BILLING_USAGE_CHUNK_SIZE
+    organization_ids: List[str] = [str(pk) for pk in Organization.objects.order_by("pk").values_list("pk", flat=True)]
+
+    for i in range(0, len(organization_ids), chunk_size):
+        if not cache_event_quotas_for_organizations(organization_ids[i : i + chunk_size]):
+            # Clickhouse not available, retry
+            raise self.retry()
+
+
+@app.task(ignore_result=True)
+def refresh_current_usage_bill_for_subscription(subscription_id: str) -> None:
+    """
+    Refreshes the cached upcoming invoice amount of a subscription in the background and releases the refresh lock
+    acquired by `get_cached_current_usage_bill`.
+    """
+
+    try:
+        refresh_current_usage_bill(subscription_id, retry_on_rate_limit=True)
+    finally:
+        release_current_usage_bill_refresh_lock(subscription_id)
+
+
+def _report_subscription_usage(
+    subscription_id: str, billed_usage: int, for_date: str, subscription_item_id: str,
+) -> Tuple[bool, str]:
+    """
+    Reports the usage of a subscription to Stripe. Returns whether the report succeeded and the metered subscription
+    item ID (which is obtained from Stripe if it was not known yet). Does not touch the database, so it can be safely
+    run from multiple threads.
+    """
+
+    try:
+        if not subscription_item_id:
+            subscription_item_id = (
+                get_metered_subscription_item_id(get_subscription(subscription_id, retry_on_rate_limit=True)) or ""
+            )
+
+        success = report_subscription_item_usage(
+            subscription_id=subscription_id,
+            billed_usage=billed_usage,
+            timestamp=dateutil.parser.parse(for_date),
+            subscription_item_id=subscription_item_id,
+            retry_on_rate_limit=True,
+        )
+    except Exception as e:
+        capture_exception(e)
+        success = False
+
+    return (success, subscription_item_id)
+
+
+def _cache_metered_subscription_item_id(subscription_id: str, subscription_item_id: str) -> None:
+    OrganizationBilling.objects.filter(stripe_subscription_id=subscription_id).update(
+        stripe_metered_subscription_item_id=subscription_item_id,
     )
 
+
+@app.task(ignore_result=True)
+def report_monthly_usage_batch(
+    usage_reports: List[Tuple[str, int, str, str]], billing_run_id: Optional[int] = None,
+) -> None:
+    """
+    Reports the usage of multiple subscriptions to Stripe from a single task, making up to
+    `BILLING_USAGE_REPORT_CONCURRENCY` concurrent requests. Each report is a
+    `(subscription_id, billed_usage, for_date, subscription_item_id)` tuple. Reports that fail are requeued
+    individually (see `report_monthly_usage`) so they can be retried on their own. The status of each organization
+    is recorded in the billing run (if any) the reports belong to.
+    """
+
+    with ThreadPoolExecutor(max_workers=settings.BILLING_USAGE_REPORT_CONCURRENCY) as executor:
+        results: List[Tuple[bool, str]] = list(
+            executor.map(lambda usage_report: _report_subscription_usage(*usage_report), usage_reports),
+        )
+
+    reported_subscription_ids: List[str] = []
+    failed_usage_reports: List[Tuple[str, int, str, str]] = []
+
+    for usage_report, (success, subscription_item_id) in zip(usage_reports, results):
+        subscription_id, billed_usage, for_date, known_subscription_item_id = usage_report
+
+        if subscription_item_id and subscription_item_id != known_subscription_item_id:
+            # Metered subscription item was not cached yet, keep it for next time (outside of the threads)
+            _cache_metered_subscription_item_id(subscription_id, subscription_item_id)
+
+        if success:
+            reported_subscription_ids.append(subscription_id)
+        else:
+            failed_usage_reports.append((subscription_id, billed_usage, for_date, subscription_item_id))
+
+    # Statuses are recorded before requeuing the failed reports, otherwise a retry that succeeds quickly could be
+    # overwritten as failed (and be reported again when the run is resumed)
+    _update_billing_run_items(
+        billing_run_id,
+        BillingRunItem.REPORTED,
+        organization_billing__stripe_subscription_id__in=reported_subscription_ids,
+    )
+    _update_billing_run_items(
+        billing_run_id,
+        BillingRunItem.FAILED,
+        organization_billing__stripe_subscription_id__in=[usage_report[0] for usage_report in failed_usage_reports],
+    )
+    _finish_billing_run(billing_run_id)
+
+    for subscription_id, billed_usage, for_date, subscription_item_id in failed_usage_reports:
+        report_monthly_usage.delay(
+            subscription_id=subscription_id,
+            billed_usage=billed_usage,
+            for_date=for_date,
+            subscription_item_id=subscription_item_id,
+            billing_run_id=billing_run_id,
+        )
+
+    # The upcoming invoices have changed with the new usage
+    invalidate_cached_current_usage_bills(reported_subscription_ids)
+
+
+@app.task(bind=True, ignore_result=True, max_retries=3)
+def report_monthly_usage(
+    self,
+    subscription_id: str,
+    billed_usage: int,
+    for_date: str,
+    subscription_item_id: str = "",
+    billing_run_id: Optional[int] = None,
+) -> None:
+
+    success, resolved_subscription_item_id = _report_subscription_usage(
+        subscription_id, billed_usage, for_date, subscription_item_id,
+    )
+
+    if resolved_subscription_item_id and resolved_subscription_item_id != subscription_item_id:
+        # Metered subscription item was not cached yet, keep it for next time
+        _cache_metered_subscription_item_id(subscription_id, resolved_subscription_item_id)
+
     if not success:
         raise self.retry()
 
+    _update_billing_run_items(
+        billing_run_id, BillingRunItem.REPORTED, organization_billing__stripe_subscription_id=subscription_id,
+    )
+    _finish_billing_run(billing_run_id)
 
-@app.task(ignore_result=True, max_retries=3)
-def report_invoice_payment_succeeded(organization_id: str, initial: bool) -> None:
+    invalidate_cached_current_usage_bills([subscription_id])
 
-    organization = Organization.objects.get(id=organization_id)
-    payload = {
+
+def _get_organization_with_billing(organization_id: str) -> Organization:
+    return Organization.objects.select_related("billing", "billing__plan").get(id=organization_id)
+
+
+def _get_billing_event_properties(organization: Organization) -> Dict:
+    return {
         "plan_key": organization.billing.get_plan_key(only_active=False),
         "billing_period_ends": organization.billing.billing_period_ends,
         "organization_id": str(organization.id),
     }
-    event = "billing subscription activated" if initial else "billing subscription paid"
 
-    for user in organization.members.all():
+
+def _capture_for_organization_members(organization: Organization, event: str, properties: Dict) -> None:
+    """
+    Reports an analytics event for every member of an organization. Only the members' distinct IDs are loaded, and
+    the events are flushed together once all of them have been queued.
+    """
+
+    for distinct_id in organization.members.values_list("distinct_id", flat=True):
         posthoganalytics.capture(
-            user.distinct_id, event, payload,
+            distinct_id, event, properties,
         )
 
+    posthoganalytics.flush()
+
+
+@app.task(ignore_result=True, max_retries=3)
+def report_invoice_payment_succeeded(organization_id: str, initial: bool) -> None:
+
+    organization = _get_organization_with_billing(organization_id)
+    event = "billing subscription activated" if initial else "billing subscription paid"
+    _capture_for_organization_members(organization, event, _get_billing_event_properties(organization))
+
 
 @app.task(ignore_result=True, max_retries=3)
 def report_card_validated(organization_id: str) -> None:
 
-    organization = Organization.objects.get(id=organization_id)
-    payload = {
-        "plan_key": organization.billing.get_plan_key(only_active=False),
-        "billing_period_ends": organization.billing.billing_period_ends,
-        "organization_id": str(organization.id),
-    }
+    organization = _get_organization_with_billing(organization_id)
+    _capture_for_organization_members(
+        organization, "billing card validated", _get_billing_event_properties(organization),
+    )
 
-    for user in organization.members.all():
-        posthoganalytics.capture(
-            user.distinct_id, "billing card validated", payload,
-        )
+
+@app.task(ignore_result=True, max_retries=3)
+def report_invoice_payment_failed(organization_id: str, attempt_count: int) -> None:
+
+    organization = _get_organization_with_billing(organization_id)
+    _capture_for_organization_members(
+        organization,
+        "billing payment failed",
+        {**_get_billing_event_properties(organization), "attempt_count": attempt_count},
+    )
 
 
 @app.task(bind=True, ignore_result=True, max_retries=3)
@@ -127,3 +506,14 @@ def update_subscription_billing_period(self, organization_id: str) -> None:
     report_invoice_payment_succeeded.delay(
         organization_id=organization.id, initial=initial_billing,
     )
+
+
+@app.task(bind=True, ignore_result=True, max_retries=3)
+def process_stripe_webhook_event(self, webhook_event_id: int) -> None:
+    """
+    Processes a Stripe webhook event stored by the `stripe_webhook` view. Failed events are retried.
+    """
+    from multi_tenancy.webhooks import process_stripe_webhook_event_by_id  # `webhooks` depends on the tasks
+
+    if process_stripe_webhook_event_by_id(webhook_event_id) is False:
+        raise self.retry(countdown=60)
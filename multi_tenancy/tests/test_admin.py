@@ -0,0 +1,146 @@
+import datetime
+from unittest.mock import patch
+
+from django.contrib.auth.models import update_last_login
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from multi_tenancy.models import DailyTeamUsage, OrganizationBilling
+from multi_tenancy.tests.base import CloudBaseTest
+from posthog.models import Team
+from rest_framework import status
+
+
+class TestOrganizationBillingAdmin(CloudBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+
+    def _create_billings(self, quantity: int) -> None:
+        plan = self.create_plan()
+        for i in range(0, quantity):
+            organization, _, _ = self.create_org_team_user()
+            OrganizationBilling.objects.create(
+                organization=organization,
+                plan=plan,
+                billing_period_ends=timezone.now() + datetime.timedelta(days=1 if i % 2 else -1),
+            )
+
+    def _get_changelist_query_count(self) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/admin/multi_tenancy/organizationbilling/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_changelist_runs_a_constant_number_of_queries(self):
+        self._create_billings(2)
+        query_count = self._get_changelist_query_count()
+
+        self._create_billings(6)
+        self.assertEqual(self._get_changelist_query_count(), query_count)
+
+    def test_changelist_shows_billing_activity_from_annotation(self):
+        self._create_billings(2)
+
+        response = self.client.get("/admin/multi_tenancy/organizationbilling/")
+        active = [billing.is_billing_active for billing in response.context["cl"].result_list]
+        self.assertEqual(
+            [billing.billing_active for billing in response.context["cl"].result_list], active,
+        )
+        self.assertEqual(sorted(active), [False, True])
+
+    def test_search_by_organization_name_member_email_and_stripe_ids(self):
+        organization, _, user = self.create_org_team_user()
+        organization.name = "Hogflix Studios"
+        organization.save()
+        billing = OrganizationBilling.objects.create(organization=organization, stripe_customer_id="cus_HoGfLiX123")
+        another_organization, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(organization=another_organization, stripe_customer_id="cus_other")
+
+        def search(term: str):
+            response = self.client.get("/admin/multi_tenancy/organizationbilling/", {"q": term})
+            return [instance.pk for instance in response.context["cl"].result_list]
+
+        self.assertEqual(search("hogflix"), [billing.pk])
+        self.assertEqual(search(user.email.upper()), [billing.pk])
+        self.assertEqual(search("cus_hogflix123"), [billing.pk])
+        self.assertEqual(search("nothing matches"), [])
+
+        # Search text is kept up to date
+        user.email = "new-billing-contact@hogflix.com"
+        user.save()
+        self.assertEqual(search("new-billing-contact@"), [billing.pk])
+
+        billing.stripe_subscription_id = "sub_hogflix"
+        billing.save()
+        self.assertEqual(search("sub_hogflix"), [billing.pk])
+
+    @patch("multi_tenancy.signals.update_billing_search_text")
+    def test_search_text_is_only_updated_when_the_user_email_changes(self, mock_update_search_text):
+        organization, _, user = self.create_org_team_user()
+
+        update_last_login(None, user)  # e.g. on every login
+        user.first_name = "Hedgehog"
+        user.save()
+        mock_update_search_text.assert_not_called()
+
+        user.email = "new-billing-contact@hogflix.com"
+        user.save()
+        mock_update_search_text.assert_called_once_with([organization.id])
+
+        mock_update_search_text.reset_mock()
+        user.email = "another-billing-contact@hogflix.com"
+        user.save(update_fields=["email"])
+        mock_update_search_text.assert_called_once_with([organization.id])
+
+    def test_changelist_shows_usage_of_allocation(self):
+        start_of_month = timezone.now().date().replace(day=1)
+        plan = self.create_plan(event_allowance=100)
+        unlimited_plan = self.create_plan()
+        billing_period_ends = timezone.now() + datetime.timedelta(days=30)
+        billings = {}
+
+        for key, billing_plan, usage in (("over", plan, 120), ("under", plan, 50), ("unlimited", unlimited_plan, 10)):
+            organization, team, _ = self.create_org_team_user()
+            billings[key] = OrganizationBilling.objects.create(
+                organization=organization, plan=billing_plan, billing_period_ends=billing_period_ends,
+            )
+            DailyTeamUsage.objects.create(team=team, date=start_of_month, event_count=usage - 1)
+            DailyTeamUsage.objects.create(
+                team=team, date=start_of_month - datetime.timedelta(days=1), event_count=1000,
+            )  # previous month
+            DailyTeamUsage.objects.create(
+                team=Team.objects.create(organization=organization), date=start_of_month, event_count=1,
+            )  # usage of every team is added up
+
+        # Sort by % of allocation (the column index includes the checkbox Django prepends for actions)
+        response = self.client.get("/admin/multi_tenancy/organizationbilling/")
+        order_by: int = response.context["cl"].list_display.index("get_usage_percentage")
+        response = self.client.get("/admin/multi_tenancy/organizationbilling/", {"o": str(order_by)})
+        results = {instance.pk: instance for instance in response.context["cl"].result_list}
+        self.assertEqual(results[billings["over"].pk].month_usage, 120)
+        self.assertEqual(results[billings["over"].pk].usage_percentage, 120)
+        self.assertEqual(results[billings["under"].pk].usage_percentage, 50)
+        self.assertEqual(results[billings["unlimited"].pk].month_usage, 10)
+        self.assertEqual(results[billings["unlimited"].pk].usage_percentage, None)
+        self.assertEqual(
+            [instance.pk for instance in response.context["cl"].result_list],
+            [billings["under"].pk, billings["over"].pk, billings["unlimited"].pk],
+        )  # organizations with unlimited allocation are sorted last
+
+        response = self.client.get("/admin/multi_tenancy/organizationbilling/", {"o": f"-{order_by}"})
+        self.assertEqual(
+            [instance.pk for instance in response.context["cl"].result_list],
+            [billings["over"].pk, billings["under"].pk, billings["unlimited"].pk],
+        )  # ... also when sorting in descending order
+
+        def filter_by(value: str):
+            response = self.client.get("/admin/multi_tenancy/organizationbilling/", {"allocation_usage": value})
+            return [instance.pk for instance in response.context["cl"].result_list]
+
+        self.assertEqual(filter_by("over"), [billings["over"].pk])
+        self.assertEqual(filter_by("under"), [billings["under"].pk])
+        self.assertEqual(filter_by("unlimited"), [billings["unlimited"].pk])
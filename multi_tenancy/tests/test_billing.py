@@ -1,18 +1,21 @@
 import datetime
 import random
 import uuid
+from decimal import Decimal
 from typing import Dict
 from unittest.mock import MagicMock, patch
 
+import pytz
 import vcr
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from ee.clickhouse.client import sync_execute
 from ee.clickhouse.models.event import create_event
 from freezegun import freeze_time
-from multi_tenancy.models import OrganizationBilling, Plan
+from multi_tenancy.models import DailyTeamUsage, DailyUsageRollup, OrganizationBilling, Plan, get_plan_registry
 from multi_tenancy.tests.base import CloudAPIBaseTest, CloudBaseTest
-from posthog.models import User
+from posthog.models import Team, User
 from rest_framework import status
 
 
@@ -178,6 +181,32 @@ class TestOrganizationBilling(CloudBaseTest):
         with self.settings(BILLING_NO_PLAN_EVENT_ALLOCATION=133):
             self.assertEqual(billing.event_allocation, 7777)
 
+    def test_plans_are_read_from_the_registry(self):
+        plan = self.create_plan(key="starter", event_allowance=100)
+        organization, _, _ = self.create_org_team_user()
+        billing = OrganizationBilling.objects.create(
+            organization=organization, plan=plan, billing_period_ends=timezone.now() + datetime.timedelta(days=4),
+        )
+        billing = OrganizationBilling.objects.get(pk=billing.pk)
+        get_plan_registry()  # warm up
+
+        with self.assertNumQueries(0):
+            self.assertEqual(billing.get_plan_key(), "starter")
+            self.assertEqual(billing.event_allocation, 100)
+            self.assertEqual(billing.available_features, ["organizations_projects"])
+
+        # Registry is reloaded when a plan is saved
+        plan.event_allowance = 200
+        plan.save()
+        self.assertEqual(billing.event_allocation, 200)
+
+        # Plans missing from the registry (e.g. the version bump isn't visible yet) cause a reload
+        another_plan = self.create_plan(key="standard", event_allowance=300)
+        get_plan_registry().pop(another_plan.id)
+        billing.plan_id = another_plan.id
+        self.assertEqual(billing.event_allocation, 300)
+        self.assertEqual(billing.get_plan_key(), "standard")
+
 
 class TestAPIOrganizationBilling(CloudAPIBaseTest):
 
@@ -281,10 +310,21 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
         )
         self.client.force_login(user)
 
+        response = self.client.get("/api/billing/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_customer_id.assert_not_called()  # reading billing information does not call Stripe
+
+        response_data: Dict = response.json()
+        self.assertEqual(response_data["should_setup_billing"], True)
+        self.assertEqual(response_data["subscription_url"], "/billing/setup")
+
+        # Checkout session is created when the user visits the subscription URL
         with self.assertLogs("multi_tenancy.stripe") as log:
 
-            response = self.client.get("/api/billing/")
-            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(response_data["subscription_url"])
+            self.assertRedirects(
+                response, "/billing/setup?session_id=cs_1234567890", fetch_redirect_response=False,
+            )
 
             self.assertIn(
                 "cus_000111222", log.output[0],
@@ -294,12 +334,6 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
                 plan.price_id, log.output[0],
             )  # Correct price ID is used
 
-        response_data: Dict = response.json()
-        self.assertEqual(response_data["should_setup_billing"], True)
-        self.assertEqual(
-            response_data["subscription_url"], "/billing/setup?session_id=cs_1234567890",
-        )
-
         self.assertEqual(
             response_data["plan"],
             {
@@ -341,8 +375,10 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
         )
         self.client.force_login(user)
 
-        response = self.client.get("/api/billing/")
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get("/billing/setup")
+        self.assertRedirects(
+            response, "/billing/setup?session_id=cs_1234567890", fetch_redirect_response=False,
+        )
 
         # Assert that Stripe was called with the correct data
         mock_checkout.assert_called_once_with(
@@ -359,6 +395,9 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
             cancel_url="http://testserver/billing/failed?session_id={CHECKOUT_SESSION_ID}",
         )
 
+        response = self.client.get("/api/billing/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
         response_data: Dict = response.json()
         self.assertEqual(response_data["should_setup_billing"], True)
         self.assertEqual(
@@ -406,8 +445,10 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
         )
         self.client.force_login(user)
 
-        response = self.client.get("/api/billing/")
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get("/billing/setup")
+        self.assertRedirects(
+            response, "/billing/setup?session_id=cs_usage_1234567890", fetch_redirect_response=False,
+        )
 
         # Assert that Stripe was called with the correct data
         mock_checkout.assert_called_once_with(
@@ -424,6 +465,9 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
             cancel_url="http://testserver/billing/failed?session_id={CHECKOUT_SESSION_ID}",
         )
 
+        response = self.client.get("/api/billing/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
         response_data: Dict = response.json()
         self.assertEqual(response_data["should_setup_billing"], True)
         self.assertEqual(
@@ -499,9 +543,13 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
 
         response_data: Dict = response.json()
         self.assertEqual(response_data["should_setup_billing"], True)
-        self.assertEqual(
-            response_data["subscription_url"],
+        self.assertEqual(response_data["subscription_url"], "/billing/setup")  # <- expired session is not used
+
+        response = self.client.get(response_data["subscription_url"])
+        self.assertRedirects(
+            response,
             "/billing/setup?session_id=cs_1234567890",  # <- note the different session
+            fetch_redirect_response=False,
         )
         mock_customer_id.assert_called_once()
 
@@ -555,13 +603,59 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
         with self.settings(STRIPE_API_KEY=""):
             response_data: Dict = self.client.get("/api/billing/").json()
 
-        self.assertEqual(response_data["should_setup_billing"], True)
-        self.assertEqual(response_data["subscription_url"], None)
-        self.assertEqual(response_data["plan"]["is_metered_billing"], False)  # Make sure the full plan object is sent
+            self.assertEqual(response_data["should_setup_billing"], True)
+            self.assertEqual(response_data["subscription_url"], "/billing/setup")
+            self.assertEqual(
+                response_data["plan"]["is_metered_billing"], False
+            )  # Make sure the full plan object is sent
+
+            with patch("multi_tenancy.views.capture_exception") as mock_capture_exception:
+                response = self.client.get(response_data["subscription_url"])
+
+        self.assertRedirects(response, "/billing/failed", fetch_redirect_response=False)
+        mock_capture_exception.assert_called_once()
 
         instance.refresh_from_db()
         self.assertEqual(instance.stripe_checkout_session, "")
 
+    @patch("multi_tenancy.stripe._get_customer_id")
+    def test_checkout_session_is_only_created_once(self, mock_customer_id):
+        mock_customer_id.return_value = "cus_000111222"
+        organization, _, user = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization, should_setup_billing=True, plan=self.create_plan(),
+        )
+        self.client.force_login(user)
+
+        for _ in range(0, 2):  # e.g. multiple tabs
+            response = self.client.get("/billing/setup")
+            self.assertRedirects(
+                response, "/billing/setup?session_id=cs_1234567890", fetch_redirect_response=False,
+            )
+
+        mock_customer_id.assert_called_once()
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_checkout_session, "cs_1234567890")
+
+    @patch("multi_tenancy.stripe._get_customer_id")
+    def test_checkout_session_is_not_created_if_billing_is_active(self, mock_customer_id):
+        organization, _, user = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization,
+            should_setup_billing=False,
+            plan=self.create_plan(),
+            billing_period_ends=timezone.now() + timezone.timedelta(days=30),
+        )
+        self.client.force_login(user)
+
+        response = self.client.get("/billing/setup")
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        mock_customer_id.assert_not_called()
+
+        self.client.logout()
+        response = self.client.get("/billing/setup")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
     @patch("multi_tenancy.utils.get_monthly_event_usage")
     def test_event_usage_is_cached(self, mock_method):
         organization, _, user = self.create_org_team_user()
@@ -616,6 +710,108 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
             cache._expire_info.get(cache.make_key(cache_key)), 1546300800.0,
         )  # 1546300800 = Jan 1, 2019 00:00 UTC
 
+    def test_event_usage_is_refreshed_incrementally(self):
+        organization, team, user = self.create_org_team_user()
+        self.client.force_login(user)
+
+        with freeze_time("2021-02-10T10:00:00Z"):
+            self.event_factory(team, 3)
+            self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 3)
+
+        with freeze_time("2021-02-10T23:00:00Z"):  # cached result has expired
+            self.event_factory(team, 2)
+
+            with patch("multi_tenancy.utils.get_event_usage_with_rollup") as mock_full_count:
+                # Stale result is returned while usage is refreshed in the background
+                self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 3)
+                self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 5)
+
+            # Only the events after the last count were counted
+            mock_full_count.assert_not_called()
+            self.assertEqual(
+                cache.get(f"monthly_usage_counter_{organization.id}")["watermark"],
+                datetime.datetime(2021, 2, 10, 23, 0, 0, tzinfo=pytz.UTC),
+            )
+
+        with freeze_time("2021-02-11T11:00:00Z"):  # a full recount is done periodically
+            cache.delete(f"monthly_usage_{organization.id}")
+            self.client.get("/api/billing/")
+            self.assertEqual(cache.get(f"monthly_usage_{organization.id}"), 5)
+            self.assertEqual(
+                cache.get(f"monthly_usage_counter_{organization.id}")["recount_at"],
+                datetime.datetime(2021, 2, 12, 11, 0, 0, tzinfo=pytz.UTC),
+            )
+
+        with freeze_time("2021-03-01T00:00:01Z"):  # counter is reset every month
+            self.event_factory(team, 1)
+            self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 1)
+
+    @patch("multi_tenancy.utils.get_event_usage_with_rollup")
+    @patch("multi_tenancy.utils.get_event_usage_after")
+    def test_event_usage_is_only_refreshed_by_one_worker_at_a_time(self, mock_incremental_count, mock_full_count):
+        organization, _, user = self.create_org_team_user()
+        self.client.force_login(user)
+
+        # Another worker is refreshing usage and there's no previous result, its result is awaited
+        cache.add(f"monthly_usage_refresh_lock_{organization.id}", True, 60)
+        with patch(
+            "multi_tenancy.utils.time.sleep",
+            side_effect=lambda _: cache.set(f"monthly_usage_{organization.id}", 5432, 60),
+        ):
+            self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 5432)
+        cache.delete(f"monthly_usage_{organization.id}")
+
+        # If the result is not ready in time, usage is counted without caching it
+        mock_full_count.return_value = 6000
+        with patch("multi_tenancy.utils.time.sleep") as mock_sleep:
+            self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 6000)
+        self.assertEqual(mock_sleep.call_count, 8)
+        mock_full_count.assert_called_once()
+        self.assertEqual(cache.get(f"monthly_usage_{organization.id}"), None)
+        mock_full_count.reset_mock()
+
+        # Another worker is refreshing usage, the stale result is returned
+        cache.set(
+            f"monthly_usage_counter_{organization.id}",
+            {
+                "start_of_month": timezone.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+                "watermark": timezone.now(),
+                "total": 8123,
+                "recount_at": timezone.now() + datetime.timedelta(hours=1),
+            },
+            60,
+        )
+        self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 8123)
+
+        mock_incremental_count.assert_not_called()
+        mock_full_count.assert_not_called()
+
+        # Once the lock is released, usage is refreshed
+        cache.delete(f"monthly_usage_refresh_lock_{organization.id}")
+        mock_incremental_count.return_value = 7
+        self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 8123)
+        mock_incremental_count.assert_called_once()
+        self.assertEqual(cache.get(f"monthly_usage_{organization.id}"), 8130)
+        self.assertEqual(cache.get(f"monthly_usage_refresh_lock_{organization.id}"), None)  # lock is released
+
+    @patch("multi_tenancy.tasks.refresh_monthly_event_usage_for_organization.delay", side_effect=Exception("No broker"))
+    def test_event_usage_refresh_lock_is_released_if_the_refresh_cannot_be_scheduled(self, _):
+        organization, _, user = self.create_org_team_user()
+        self.client.force_login(user)
+        cache.set(
+            f"monthly_usage_counter_{organization.id}",
+            {
+                "start_of_month": timezone.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+                "watermark": timezone.now(),
+                "total": 8123,
+                "recount_at": timezone.now() + datetime.timedelta(hours=1),
+            },
+            60,
+        )
+
+        self.assertEqual(self.client.get("/api/billing/").json()["current_usage"], 8123)  # stale result is returned
+        self.assertEqual(cache.get(f"monthly_usage_refresh_lock_{organization.id}"), None)
+
     def test_user_with_no_org(self):
         """
         Tests the edge case of user not belonging to any organization to make sure the `/api/user` request is handled
@@ -808,6 +1004,116 @@ class TestAPIOrganizationBilling(CloudAPIBaseTest):
         self.assertEqual(response.json()["current_bill_amount"], None)
         self.assertEqual(response.json()["should_display_current_bill"], True)
 
+    @patch("multi_tenancy.stripe._init_stripe")
+    @patch("multi_tenancy.stripe.stripe.Invoice.upcoming")
+    def test_bill_usage_is_cached_and_refreshed_in_the_background(self, mock_upcoming_invoice, _):
+        organization, _, user = self.create_org_team_user()
+        plan = self.create_plan(key="usage3", is_metered_billing=True)
+        OrganizationBilling.objects.create(
+            organization=organization,
+            plan=plan,
+            stripe_subscription_id="sub_cached",
+            billing_period_ends=timezone.now() + datetime.timedelta(days=30),
+        )
+        self.client.force_login(user)
+        mock_upcoming_invoice.return_value = {"amount_due": 1500}
+
+        with freeze_time("2020-05-10T10:00:00Z"):
+            self.assertEqual(self.client.get("/api/billing/").json()["current_bill_amount"], 15)
+            self.assertEqual(self.client.get("/api/billing/").json()["current_bill_amount"], 15)
+
+        mock_upcoming_invoice.assert_called_once_with(subscription="sub_cached")  # second request read the cache
+
+        # Once the cached amount expires, it is refreshed in the background (eager in tests)
+        mock_upcoming_invoice.return_value = {"amount_due": 2000}
+        with freeze_time("2020-05-10T12:00:00Z"):
+            self.assertEqual(self.client.get("/api/billing/").json()["current_bill_amount"], 15)
+            self.assertEqual(self.client.get("/api/billing/").json()["current_bill_amount"], 20)
+
+        self.assertEqual(mock_upcoming_invoice.call_count, 2)
+        self.assertEqual(cache.get("current_bill_refresh_lock_sub_cached"), None)  # lock is released
+
+    @patch("multi_tenancy.tasks.refresh_current_usage_bill_for_subscription.delay", side_effect=Exception("No broker"))
+    def test_bill_usage_refresh_lock_is_released_if_the_refresh_cannot_be_scheduled(self, _):
+        organization, _, user = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization,
+            plan=self.create_plan(key="usage4", is_metered_billing=True),
+            stripe_subscription_id="sub_stale",
+            billing_period_ends=timezone.now() + datetime.timedelta(days=30),
+        )
+        self.client.force_login(user)
+        cache.set("current_bill_sub_stale", {"amount": Decimal("15"), "expires_at": timezone.now()}, 60)
+
+        response = self.client.get("/api/billing/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["current_bill_amount"], 15)  # stale amount is returned
+        self.assertEqual(cache.get("current_bill_refresh_lock_sub_stale"), None)
+
+    @freeze_time("2021-05-03T15:00:00Z")
+    def test_event_usage_breakdown_per_team_and_day(self):
+        organization, team, user = self.create_org_team_user()
+        team2 = Team.objects.create(organization=organization, name="Second project")
+        self.client.force_login(user)
+
+        # May 1st has been rolled up, the rest is counted from raw events
+        DailyTeamUsage.objects.create(team=team, date=datetime.date(2021, 5, 1), event_count=120)
+        DailyUsageRollup.objects.create(date=datetime.date(2021, 5, 1))
+        with freeze_time("2021-05-02T10:00:00Z"):
+            self.event_factory(team, 2)
+            self.event_factory(team2, 1)
+        self.event_factory(team2, 4)
+
+        with patch("multi_tenancy.utils.sync_execute", wraps=sync_execute) as mock_sync_execute:
+            response = self.client.get("/api/billing/usage")
+            self.assertEqual(self.client.get("/api/billing/usage").json(), response.json())  # cached
+
+        mock_sync_execute.assert_called_once()  # single grouped query for all teams & days
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "date_from": "2021-05-01",
+                "date_to": "2021-05-03",
+                "teams": [
+                    {
+                        "id": team.id,
+                        "name": team.name,
+                        "total": 122,
+                        "usage": [
+                            {"date": "2021-05-01", "events": 120},
+                            {"date": "2021-05-02", "events": 2},
+                            {"date": "2021-05-03", "events": 0},
+                        ],
+                    },
+                    {
+                        "id": team2.id,
+                        "name": "Second project",
+                        "total": 5,
+                        "usage": [
+                            {"date": "2021-05-01", "events": 0},
+                            {"date": "2021-05-02", "events": 1},
+                            {"date": "2021-05-03", "events": 4},
+                        ],
+                    },
+                ],
+            },
+        )
+
+        # Ranges are cached separately
+        response = self.client.get("/api/billing/usage?date_from=2021-05-02&date_to=2021-05-02")
+        self.assertEqual([team["total"] for team in response.json()["teams"]], [2, 1])
+
+    def test_event_usage_breakdown_validates_date_range(self):
+        _, _, user = self.create_org_team_user()
+        self.client.force_login(user)
+
+        response = self.client.get("/api/billing/usage?date_from=2021-05-02&date_to=2021-05-01")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get("/api/billing/usage?date_from=2019-01-01&date_to=2021-05-01")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class PlanAPITestCase(CloudAPIBaseTest):
     def setUp(self):
@@ -3,6 +3,8 @@ from urllib.parse import quote
 
 from django.test.client import Client
 from multi_tenancy.tests.base import CloudAPIBaseTest
+from multi_tenancy.utils import get_current_team_snapshot
+from posthog.models import Team
 from rest_framework import status
 
 
@@ -93,3 +95,45 @@ class TestPostHogTokenCookieMiddleware(CloudAPIBaseTest):
         response = self.client.get("/logout")
         self.assertEqual("ph_current_project_token" in response.cookies, False)
         self.assertEqual("ph_current_project_name" in response.cookies, False)
+
+    def test_cookies_are_only_set_when_they_change(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/")
+        self.assertIn("ph_current_project_token", response.cookies)
+        self.assertIn("ph_current_project_name", response.cookies)
+
+        # The client already has the cookies with the current values
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("ph_current_project_token", response.cookies)
+        self.assertNotIn("ph_current_project_name", response.cookies)
+
+        # Only the cookie that changed is set again
+        self.team.name = "Renamed project"
+        self.team.save()
+        response = self.client.get("/")
+        self.assertNotIn("ph_current_project_token", response.cookies)
+        self.assertEqual(response.cookies["ph_current_project_name"].value, "Renamed project")
+
+    def test_current_team_is_cached_per_user(self):
+        self.client.force_login(self.user)
+        self.client.get("/")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_current_team_snapshot(self.user), {"api_token": self.team.api_token, "name": self.team.name},
+            )
+
+        # Cached team is invalidated when the team changes
+        self.team.name = "Another name"
+        self.team.save()
+        self.assertEqual(get_current_team_snapshot(self.user)["name"], "Another name")
+
+        # ... or when the user switches teams
+        another_team = Team.objects.create(organization=self.organization, name="Second project")
+        self.user.current_team = another_team
+        self.user.save()
+        self.client.cookies.pop("ph_current_project_token")
+        response = self.client.get("/")
+        self.assertEqual(response.cookies["ph_current_project_token"].value, another_team.api_token)
+        self.assertEqual(response.cookies["ph_current_project_name"].value, "Second project")
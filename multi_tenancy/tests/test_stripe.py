@@ -0,0 +1,76 @@
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from multi_tenancy.stripe import _request, _wait_for_rate_limit
+from multi_tenancy.tests.base import CloudBaseTest
+
+import stripe
+
+
+class TestStripe(CloudBaseTest):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @patch("multi_tenancy.stripe.time.sleep")
+    def test_rate_limited_requests_are_retried_following_retry_after(self, mock_sleep):
+        method = MagicMock(
+            side_effect=[stripe.error.RateLimitError("Too many requests", headers={"Retry-After": "2"}), "result"],
+        )
+
+        with self.settings(STRIPE_MAX_RETRIES=3):
+            self.assertEqual(_request(method, "sub_1", quantity=10, retry_on_rate_limit=True), "result")
+
+        self.assertEqual(method.call_count, 2)
+        method.assert_called_with("sub_1", quantity=10)
+        mock_sleep.assert_called_once_with(2.0)
+
+    @patch("multi_tenancy.stripe.time.sleep")
+    def test_rate_limited_requests_back_off_exponentially_and_give_up(self, mock_sleep):
+        method = MagicMock(side_effect=stripe.error.RateLimitError("Too many requests"))
+
+        with self.settings(STRIPE_MAX_RETRIES=3):
+            with self.assertRaises(stripe.error.RateLimitError):
+                _request(method, retry_on_rate_limit=True)
+
+        self.assertEqual(method.call_count, 4)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+        backoffs = [call[0][0] for call in mock_sleep.call_args_list]
+        self.assertEqual(backoffs, sorted(backoffs))  # increasing backoff
+        self.assertTrue(all(0 < backoff <= 30 for backoff in backoffs))
+
+    @patch("multi_tenancy.stripe.time.sleep")
+    def test_rate_limited_requests_fail_fast_unless_retrying_is_requested(self, mock_sleep):
+        method = MagicMock(
+            side_effect=stripe.error.RateLimitError("Too many requests", headers={"Retry-After": "20"}),
+        )
+
+        with self.settings(STRIPE_MAX_RETRIES=3):
+            with self.assertRaises(stripe.error.RateLimitError):
+                _request(method)  # e.g. from a web request
+
+        self.assertEqual(method.call_count, 2)  # a single retry
+        mock_sleep.assert_called_once_with(1.0)  # `Retry-After` is capped to a short backoff
+
+    @patch("multi_tenancy.stripe.time.sleep")
+    def test_requests_wait_when_the_shared_rate_limit_is_exhausted(self, mock_sleep):
+        mock_sleep.side_effect = lambda _: cache.clear()  # simulates the next window starting
+
+        with self.settings(STRIPE_MAX_REQUESTS_PER_SECOND=2):
+            _wait_for_rate_limit()
+            _wait_for_rate_limit()
+            mock_sleep.assert_not_called()
+
+            _wait_for_rate_limit()  # third request in the same window has to wait for the next one
+
+        mock_sleep.assert_called_once()
+        self.assertTrue(0 <= mock_sleep.call_args[0][0] <= 1)
+
+    @patch("multi_tenancy.stripe.time.sleep")
+    def test_requests_that_dont_block_wait_at_most_for_the_next_window(self, mock_sleep):
+        with self.settings(STRIPE_MAX_REQUESTS_PER_SECOND=1):
+            _wait_for_rate_limit(block=False)
+            _wait_for_rate_limit(block=False)  # budget exhausted, waits for the next window (which is not refilled)
+
+        mock_sleep.assert_called_once()
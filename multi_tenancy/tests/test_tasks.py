@@ -2,10 +2,29 @@ import datetime
 from unittest.mock import MagicMock, patch
 
 import pytz
+from django.core.cache import cache
+from django.utils import timezone
+from ee.clickhouse.client import sync_execute
 from freezegun import freeze_time
-from multi_tenancy.models import OrganizationBilling, Plan
-from multi_tenancy.tasks import compute_daily_usage_for_organizations
+from multi_tenancy.models import (
+    BillingRun,
+    BillingRunItem,
+    DailyTeamUsage,
+    DailyUsageRollup,
+    OrganizationBilling,
+    Plan,
+)
+from multi_tenancy.tasks import (
+    _compute_daily_usage_for_organizations,
+    compute_daily_usage_for_organizations,
+    refresh_event_quotas,
+    report_card_validated,
+    report_monthly_usage_batch,
+    rollup_daily_team_usage,
+)
 from multi_tenancy.tests.base import CloudBaseTest
+from multi_tenancy.utils import get_event_quota, is_over_event_quota
+from posthog.models import Organization, Team, User
 
 
 class TestTasks(CloudBaseTest):
@@ -59,23 +78,54 @@ class TestTasks(CloudBaseTest):
         compute_daily_usage_for_organizations()
         self.assertEqual(mock_create_usage_record.call_count, 2)
 
-        # team
-        self.assertEqual(mock_create_usage_record.call_args_list[0].args, ("si_1111111111111",))
-        self.assertEqual(mock_create_usage_record.call_args_list[0].kwargs["quantity"], 14)
-        self.assertEqual(
-            mock_create_usage_record.call_args_list[0].kwargs["idempotency_key"], "si_1111111111111-2020-05-06",
-        )
+        # Usage is reported concurrently, so the order of the calls is not deterministic
+        # This would be normally be a different ID, but for test purposes, we're mocking the same ID
+        for call in mock_create_usage_record.call_args_list:
+            self.assertEqual(call.args, ("si_1111111111111",))
+            self.assertEqual(call.kwargs["idempotency_key"], "si_1111111111111-2020-05-06")
 
-        # another team
         self.assertEqual(
-            mock_create_usage_record.call_args_list[1].args, ("si_1111111111111",),
-        )  # This would be normally be a different ID, but for test purposes, we're mocking the same ID
-        self.assertEqual(mock_create_usage_record.call_args_list[1].kwargs["quantity"], 11)
-        self.assertEqual(
-            mock_create_usage_record.call_args_list[1].kwargs["idempotency_key"], "si_1111111111111-2020-05-06",
+            sorted(call.kwargs["quantity"] for call in mock_create_usage_record.call_args_list), [11, 14],
+        )  # team & another team
+
+    @freeze_time("2020-05-07")
+    @patch("multi_tenancy.stripe._init_stripe")
+    @patch("multi_tenancy.stripe.stripe.SubscriptionItem.create_usage_record")
+    @patch("multi_tenancy.stripe.stripe.Subscription.retrieve")
+    def test_metered_subscription_item_is_cached(self, mock_subscription_retrieve, mock_create_usage_record, _):
+        plan = Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True)
+        org, team, _ = self.create_org_team_user()
+        instance = OrganizationBilling.objects.create(
+            organization=org, stripe_subscription_id="sub_123456789", plan=plan,
         )
+        mock_subscription_retrieve.return_value = {
+            "items": {
+                "data": [
+                    {"id": "si_flat", "price": {"recurring": {"usage_type": "licensed"}}},
+                    {"id": "si_metered", "price": {"recurring": {"usage_type": "metered"}}},
+                ]
+            }
+        }
+
+        with freeze_time("2020-05-06T10:00:00"):
+            self.event_factory(team, 3)
+
+        compute_daily_usage_for_organizations()
+        mock_subscription_retrieve.assert_called_once_with("sub_123456789")
+        self.assertEqual(mock_create_usage_record.call_args.args, ("si_metered",))
 
-    @patch("multi_tenancy.tasks._compute_daily_usage_for_organization")
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "si_metered")
+
+        # Next run uses the cached subscription item; only one call to Stripe is made
+        with freeze_time("2020-05-08"):
+            compute_daily_usage_for_organizations()
+        mock_subscription_retrieve.assert_called_once()
+        self.assertEqual(mock_create_usage_record.call_count, 2)
+        self.assertEqual(mock_create_usage_record.call_args.args, ("si_metered",))
+        self.assertEqual(mock_create_usage_record.call_args.kwargs["idempotency_key"], "si_metered-2020-05-07")
+
+    @patch("multi_tenancy.tasks._compute_daily_usage_for_organizations")
     def test_only_rerport_relevant_usage_for_organizations(self, mock_individual_org_task):
         plan = Plan.objects.create(key="unmetered", price_id="u1", name="Flat fee")
         org, _, _ = self.create_org_team_user()
@@ -137,3 +187,354 @@ class TestTasks(CloudBaseTest):
         self.assertEqual(
             mock_create_usage_record.call_args_list[0].kwargs["idempotency_key"], "si_J2i9eUttdXoSlA-2020-11-03",
         )
+
+    @patch("multi_tenancy.tasks.group")
+    def test_daily_usage_is_computed_in_chunks(self, mock_group):
+        plan = Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True)
+        pks = []
+        for i in range(0, 5):
+            org, _, _ = self.create_org_team_user()
+            OrganizationBilling.objects.create(organization=org, stripe_subscription_id=f"sub_{i}", plan=plan)
+            pks.append(str(org.pk))
+
+        with self.settings(BILLING_USAGE_CHUNK_SIZE=2):
+            compute_daily_usage_for_organizations()
+
+        # Chunks are dispatched together as a group
+        mock_group.return_value.apply_async.assert_called_once()
+        signatures = list(mock_group.call_args.args[0])
+        self.assertEqual(len(signatures), 3)
+        dispatched_pks = []
+        for signature in signatures:
+            self.assertLessEqual(len(signature.kwargs["organization_billing_pks"]), 2)
+            dispatched_pks += signature.kwargs["organization_billing_pks"]
+        self.assertEqual(sorted(dispatched_pks), sorted(pks))  # every organization is dispatched exactly once
+
+    @freeze_time("2020-05-07")
+    @patch("multi_tenancy.tasks.report_monthly_usage.delay")
+    @patch("multi_tenancy.stripe._init_stripe")
+    @patch("multi_tenancy.stripe.stripe.SubscriptionItem.create_usage_record")
+    def test_billing_run_can_be_resumed(self, mock_create_usage_record, _, mock_report_usage):
+        plan = Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True)
+        org, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=org, stripe_subscription_id="sub_1", stripe_metered_subscription_item_id="si_1", plan=plan,
+        )
+        another_org, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=another_org,
+            stripe_subscription_id="sub_2",
+            stripe_metered_subscription_item_id="si_2",
+            plan=plan,
+        )
+
+        def create_usage_record(subscription_item_id, **kwargs):
+            if subscription_item_id == "si_2":
+                raise Exception("Stripe is down")
+            return MagicMock()
+
+        item_statuses = []
+
+        def record_item_status(*args, **kwargs):
+            item_statuses.append(BillingRunItem.objects.get(organization_billing__organization=another_org).status)
+            return MagicMock()
+
+        mock_create_usage_record.side_effect = create_usage_record
+        mock_report_usage.side_effect = record_item_status
+        compute_daily_usage_for_organizations()
+
+        billing_run = BillingRun.objects.get(for_date=datetime.date(2020, 5, 6))
+        self.assertEqual(billing_run.status, BillingRun.FAILED)
+        self.assertIsNotNone(billing_run.finished_at)
+        self.assertEqual(
+            dict(billing_run.items.values_list("organization_billing_id", "status")),
+            {org.pk: BillingRunItem.REPORTED, another_org.pk: BillingRunItem.FAILED},
+        )
+        mock_report_usage.assert_called_once()  # failed report is requeued
+        self.assertEqual(item_statuses, [BillingRunItem.FAILED])  # ... after its status is recorded
+
+        # Resuming the run only reports the usage of the organization that failed
+        mock_create_usage_record.reset_mock()
+        mock_create_usage_record.side_effect = None
+        item_statuses.clear()
+
+        def report_usage_batch(**kwargs):
+            record_item_status()
+            report_monthly_usage_batch(**kwargs)
+
+        with patch("multi_tenancy.tasks.report_monthly_usage_batch.delay", side_effect=report_usage_batch):
+            compute_daily_usage_for_organizations()
+
+        self.assertEqual(item_statuses, [BillingRunItem.IN_PROGRESS])  # claimed again until reported
+        mock_create_usage_record.assert_called_once()
+        self.assertEqual(mock_create_usage_record.call_args.args, ("si_2",))
+
+        billing_run.refresh_from_db()
+        self.assertEqual(billing_run.status, BillingRun.COMPLETED)
+        self.assertEqual(BillingRun.objects.count(), 1)
+        self.assertEqual(billing_run.items.filter(status=BillingRunItem.REPORTED).count(), 2)
+
+    @freeze_time("2020-05-07T10:00:00Z")
+    @patch("multi_tenancy.tasks.report_monthly_usage_batch.delay")
+    def test_resumed_billing_run_does_not_report_organizations_in_progress(self, mock_report_usage):
+        plan = Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True)
+        org, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(organization=org, stripe_subscription_id="sub_1", plan=plan)
+        another_org, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(organization=another_org, stripe_subscription_id="sub_2", plan=plan)
+
+        billing_run = BillingRun.objects.create(for_date=datetime.date(2020, 5, 6))
+        BillingRunItem.objects.create(
+            billing_run=billing_run, organization_billing_id=org.pk, status=BillingRunItem.IN_PROGRESS,
+        )  # chunk is still running
+        with freeze_time("2020-05-07T08:00:00Z"):
+            BillingRunItem.objects.create(
+                billing_run=billing_run, organization_billing_id=another_org.pk, status=BillingRunItem.IN_PROGRESS,
+            )  # chunk never finished (e.g. the worker died)
+
+        compute_daily_usage_for_organizations()
+
+        # Only the stale organization is dispatched (and claimed) again
+        mock_report_usage.assert_called_once()
+        self.assertEqual(
+            [usage_report[0] for usage_report in mock_report_usage.call_args.kwargs["usage_reports"]], ["sub_2"],
+        )
+        self.assertEqual(set(billing_run.items.values_list("status", flat=True)), {BillingRunItem.IN_PROGRESS})
+        billing_run.refresh_from_db()
+        self.assertEqual(billing_run.status, BillingRun.RUNNING)
+
+        # A chunk delivered twice doesn't report again organizations it can't claim
+        mock_report_usage.reset_mock()
+        _compute_daily_usage_for_organizations(
+            organization_billing_pks=[str(org.pk), str(another_org.pk)],
+            for_date="2020-05-06",
+            billing_run_id=billing_run.pk,
+        )
+        mock_report_usage.assert_not_called()
+
+    @freeze_time("2020-05-07")
+    @patch("multi_tenancy.tasks.report_monthly_usage_batch.delay")
+    def test_daily_usage_for_a_chunk_is_computed_with_a_single_query(self, mock_report_usage):
+        plan = Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True)
+        org, team, _ = self.create_org_team_user()
+        team2 = Team.objects.create(organization=org)
+        OrganizationBilling.objects.create(organization=org, stripe_subscription_id="sub_1", plan=plan)
+        another_org, _, _ = self.create_org_team_user()  # no events
+        OrganizationBilling.objects.create(organization=another_org, stripe_subscription_id="sub_2", plan=plan)
+
+        with freeze_time("2020-05-06T13:01:01"):
+            self.event_factory(team, 3)
+            self.event_factory(team2, 2)
+
+        with patch("multi_tenancy.utils.sync_execute", wraps=sync_execute) as mock_sync_execute:
+            compute_daily_usage_for_organizations()
+
+        mock_sync_execute.assert_called_once()
+        mock_report_usage.assert_called_once()  # the whole chunk is reported by a single task
+        reported = {
+            subscription_id: billed_usage
+            for subscription_id, billed_usage, _, _ in mock_report_usage.call_args.kwargs["usage_reports"]
+        }
+        self.assertEqual(reported, {"sub_1": 5, "sub_2": 0})
+
+    @patch("multi_tenancy.tasks.report_monthly_usage.delay")
+    @patch("multi_tenancy.stripe._init_stripe")
+    @patch("multi_tenancy.stripe.stripe.SubscriptionItem.create_usage_record")
+    @patch("multi_tenancy.stripe.stripe.Subscription.retrieve")
+    def test_failed_usage_reports_in_a_batch_are_requeued_individually(
+        self, mock_subscription_retrieve, mock_create_usage_record, _, mock_report_usage,
+    ):
+        plan = Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True)
+        org, _, _ = self.create_org_team_user()
+        instance = OrganizationBilling.objects.create(organization=org, stripe_subscription_id="sub_new", plan=plan)
+        mock_subscription_retrieve.return_value = {
+            "items": {"data": [{"id": "si_new", "price": {"recurring": {"usage_type": "metered"}}}]}
+        }
+
+        def create_usage_record(subscription_item_id, **kwargs):
+            if subscription_item_id == "si_failing":
+                raise Exception("Stripe is down")
+            return MagicMock()
+
+        mock_create_usage_record.side_effect = create_usage_record
+        cache.set("current_bill_sub_ok", {"amount": None, "expires_at": timezone.now()})
+        cache.set("current_bill_sub_failing", {"amount": None, "expires_at": timezone.now()})
+
+        report_monthly_usage_batch(
+            usage_reports=[
+                ("sub_ok", 10, "2020-05-06T00:00:00", "si_ok"),
+                ("sub_failing", 20, "2020-05-06T00:00:00", "si_failing"),
+                ("sub_new", 30, "2020-05-06T00:00:00", ""),
+            ],
+        )
+
+        self.assertEqual(mock_create_usage_record.call_count, 3)
+        mock_subscription_retrieve.assert_called_once_with("sub_new")
+
+        # Only the failed report is requeued
+        mock_report_usage.assert_called_once_with(
+            subscription_id="sub_failing",
+            billed_usage=20,
+            for_date="2020-05-06T00:00:00",
+            subscription_item_id="si_failing",
+            billing_run_id=None,
+        )
+
+        # Subscription item obtained from Stripe is cached
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "si_new")
+
+        # Cached upcoming invoices are invalidated only for the reported subscriptions
+        self.assertEqual(cache.get("current_bill_sub_ok"), None)
+        self.assertNotEqual(cache.get("current_bill_sub_failing"), None)
+
+    @freeze_time("2020-05-04T02:00:00Z")
+    def test_rollup_daily_team_usage(self):
+        _, team, _ = self.create_org_team_user()
+        _, another_team, _ = self.create_org_team_user()
+
+        with freeze_time("2020-05-01T10:00:00"):
+            self.event_factory(team, 2)
+        with freeze_time("2020-05-03T23:59:30"):
+            self.event_factory(team, 4)
+            self.event_factory(another_team, 1)
+        with freeze_time("2020-05-04T01:00:00"):  # today, not rolled up yet
+            self.event_factory(team, 9)
+
+        rollup_daily_team_usage()
+
+        self.assertEqual(
+            sorted(DailyTeamUsage.objects.values_list("team_id", "date", "event_count")),
+            sorted(
+                [
+                    (team.id, datetime.date(2020, 5, 1), 2),
+                    (team.id, datetime.date(2020, 5, 3), 4),
+                    (another_team.id, datetime.date(2020, 5, 3), 1),
+                ]
+            ),
+        )
+        self.assertEqual(
+            list(DailyUsageRollup.objects.order_by("date").values_list("date", flat=True)),
+            [datetime.date(2020, 5, 1), datetime.date(2020, 5, 2), datetime.date(2020, 5, 3)],
+        )  # days without events are recorded as rolled up too
+
+        # Subsequent runs only process the days after the last rollup, plus the most recent days again
+        with freeze_time("2020-05-06T02:00:00Z"):
+            with freeze_time("2020-05-04T01:00:00"):
+                self.event_factory(another_team, 3)
+
+            with patch("multi_tenancy.tasks.get_teams_event_usage_for_timerange", return_value={}) as mock_usage:
+                rollup_daily_team_usage()
+            self.assertEqual(
+                [call.kwargs["start_time"].date() for call in mock_usage.call_args_list],
+                [datetime.date(2020, 5, 4), datetime.date(2020, 5, 5)],
+            )
+
+    @freeze_time("2020-05-04T02:00:00Z")
+    def test_rollup_daily_team_usage_includes_events_ingested_late(self):
+        _, team, _ = self.create_org_team_user()
+
+        with freeze_time("2020-05-03T12:00:00"):
+            self.event_factory(team, 2)
+        rollup_daily_team_usage()
+        self.assertEqual(DailyTeamUsage.objects.get(team=team, date=datetime.date(2020, 5, 3)).event_count, 2)
+
+        # An event for May 3rd is ingested after the rollup; the next run counts the day again
+        with freeze_time("2020-05-03T23:59:00"):
+            self.event_factory(team, 1)
+        with freeze_time("2020-05-05T02:00:00Z"):
+            rollup_daily_team_usage()
+        self.assertEqual(DailyTeamUsage.objects.get(team=team, date=datetime.date(2020, 5, 3)).event_count, 3)
+
+        # Days that aren't over can't be rolled up (which would make later runs skip them)
+        with self.assertRaises(ValueError):
+            rollup_daily_team_usage(for_date="2020-05-04")
+
+    def test_rollup_daily_team_usage_for_specific_date_replaces_existing_rows(self):
+        _, team, _ = self.create_org_team_user()
+        DailyTeamUsage.objects.create(team=team, date=datetime.date(2020, 2, 10), event_count=999)
+
+        with freeze_time("2020-02-10T10:00:00"):
+            self.event_factory(team, 3)
+
+        rollup_daily_team_usage(for_date="2020-02-10")
+
+        self.assertEqual(DailyTeamUsage.objects.get(team=team, date=datetime.date(2020, 2, 10)).event_count, 3)
+
+    @freeze_time("2021-03-15T10:00:00Z")
+    def test_refresh_event_quotas(self):
+        plan = Plan.objects.create(key="quota", name="Quota", price_id="q1", event_allowance=5)
+        org, team, _ = self.create_org_team_user()
+        team2 = Team.objects.create(organization=org)
+        OrganizationBilling.objects.create(
+            organization=org, plan=plan, billing_period_ends=datetime.datetime(2021, 4, 1, tzinfo=pytz.UTC),
+        )
+        another_org, another_team, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=another_org, plan=plan, billing_period_ends=datetime.datetime(2021, 4, 1, tzinfo=pytz.UTC),
+        )
+        no_billing_org, no_billing_team, _ = self.create_org_team_user()
+
+        with freeze_time("2021-03-02T10:00:00Z"):
+            self.event_factory(team, 2)
+            self.event_factory(team2, 4)
+            self.event_factory(another_team, 1)
+            self.event_factory(no_billing_team, 3)
+
+        with self.settings(BILLING_NO_PLAN_EVENT_ALLOCATION=2, BILLING_USAGE_CHUNK_SIZE=2):
+            with patch("multi_tenancy.utils.sync_execute", wraps=sync_execute) as mock_sync_execute:
+                refresh_event_quotas()
+
+        # One grouped query per chunk of organizations
+        self.assertEqual(mock_sync_execute.call_count, (Organization.objects.count() + 1) // 2)
+
+        # Quota is shared by all teams of the organization
+        for api_token in (team.api_token, team2.api_token):
+            self.assertEqual(get_event_quota(api_token), {"allocation": 5, "usage": 6, "over_limit": True})
+            self.assertTrue(is_over_event_quota(api_token))
+        self.assertEqual(get_event_quota(another_team.api_token), {"allocation": 5, "usage": 1, "over_limit": False})
+        self.assertFalse(is_over_event_quota(another_team.api_token))
+        self.assertEqual(
+            get_event_quota(no_billing_team.api_token), {"allocation": 2, "usage": 3, "over_limit": True},
+        )  # no billing, default allocation applies
+
+        # Unknown quotas are never enforced
+        self.assertEqual(get_event_quota("unknown_token"), None)
+        self.assertFalse(is_over_event_quota("unknown_token"))
+
+        # Reading a quota doesn't touch the database
+        with self.assertNumQueries(0):
+            is_over_event_quota(team.api_token)
+
+        # The monthly event usage cache (including the incremental counter) is warmed too
+        self.assertEqual(cache.get(f"monthly_usage_{org.id}"), 6)
+        self.assertEqual(cache.get(f"monthly_usage_{no_billing_org.id}"), 3)
+        self.assertEqual(cache.get(f"monthly_usage_counter_{org.id}")["total"], 6)
+        self.assertEqual(
+            cache.get(f"monthly_usage_counter_{org.id}")["watermark"],
+            datetime.datetime(2021, 3, 15, 10, 0, 0, tzinfo=pytz.UTC),
+        )
+
+    @patch("posthoganalytics.flush")
+    @patch("posthoganalytics.capture")
+    def test_organization_wide_billing_events_are_captured_in_a_batch(self, mock_capture, mock_flush):
+        organization, _, user = self.create_org_team_user()
+        OrganizationBilling.objects.create(organization=organization, plan=self.create_plan(key="startup"))
+        members = [user]
+        for i in range(0, 4):
+            member = User.objects.create_user(email=f"member_{i}@posthog.com", first_name="X", password="12345678")
+            member.join(organization=organization)
+            members.append(member)
+
+        with self.assertNumQueries(2):  # organization with billing & plan, members' distinct IDs
+            report_card_validated(organization_id=str(organization.id))
+
+        self.assertEqual(mock_capture.call_count, 5)
+        for member in members:
+            mock_capture.assert_any_call(
+                member.distinct_id,
+                "billing card validated",
+                {"plan_key": "startup", "billing_period_ends": None, "organization_id": str(organization.id)},
+            )
+        mock_flush.assert_called_once()  # events are sent together
+
@@ -3,8 +3,15 @@ import datetime
 import pytz
 from django.utils import timezone
 from freezegun import freeze_time
+from multi_tenancy.models import DailyTeamUsage, DailyUsageRollup
 from multi_tenancy.tests.base import CloudBaseTest
-from multi_tenancy.utils import get_billing_cycle_anchor, get_event_usage_for_timerange
+from multi_tenancy.utils import (
+    get_billing_cycle_anchor,
+    get_event_usage_breakdown,
+    get_event_usage_for_timerange,
+    get_monthly_event_usage,
+    get_organizations_event_usage_for_timerange,
+)
 from posthog.models import Team
 
 
@@ -93,3 +100,89 @@ class TestUtils(CloudBaseTest):
             8,
         )
 
+    def test_get_organizations_event_usage_for_timerange(self):
+
+        org, team, _ = self.create_org_team_user()
+        team2 = Team.objects.create(organization=org)
+        another_org, another_team, _ = self.create_org_team_user()
+        empty_org, _, _ = self.create_org_team_user()
+        _, noise_team, _ = self.create_org_team_user()
+
+        with freeze_time("2020-03-02"):
+            self.event_factory(team, 4)
+            self.event_factory(team2, 3)
+            self.event_factory(another_team, 8)
+            self.event_factory(noise_team, 5)  # organization not requested
+
+        with freeze_time("2020-03-03"):
+            self.event_factory(team, 2)
+
+        self.assertEqual(
+            get_organizations_event_usage_for_timerange(
+                [str(org.id), str(another_org.id), str(empty_org.id)],
+                datetime.datetime(2020, 3, 2, 0, 0, 0, 0, pytz.UTC),
+                datetime.datetime(2020, 3, 2, 23, 59, 59, 999999, pytz.UTC),
+            ),
+            {str(org.id): 7, str(another_org.id): 8, str(empty_org.id): 0},
+        )
+
+    @freeze_time("2020-03-10T12:00:00Z")
+    def test_monthly_event_usage_reads_from_rollup(self):
+
+        org, team, _ = self.create_org_team_user()
+        team2 = Team.objects.create(organization=org)
+        _, another_team, _ = self.create_org_team_user()
+
+        # Rolled up days (no raw events, to ensure the rollup is used)
+        DailyTeamUsage.objects.create(team=team, date=datetime.date(2020, 3, 1), event_count=1000)
+        DailyTeamUsage.objects.create(team=team2, date=datetime.date(2020, 3, 8), event_count=200)
+        DailyTeamUsage.objects.create(team=another_team, date=datetime.date(2020, 3, 8), event_count=30)
+        DailyTeamUsage.objects.create(team=team, date=datetime.date(2020, 2, 29), event_count=4)  # previous month
+        DailyUsageRollup.objects.bulk_create(
+            [DailyUsageRollup(date=datetime.date(2020, 2, 29) + datetime.timedelta(days=i)) for i in range(0, 9)],
+        )
+
+        # Days after the last rollup are counted from raw events
+        with freeze_time("2020-03-08T10:00:00"):
+            self.event_factory(team, 5)  # already rolled up, must not be counted twice
+        with freeze_time("2020-03-09T10:00:00"):
+            self.event_factory(team, 7)
+        with freeze_time("2020-03-10T10:00:00"):
+            self.event_factory(team2, 2)
+
+        self.assertEqual(get_monthly_event_usage(org), 1209)
+
+    @freeze_time("2020-03-10T12:00:00Z")
+    def test_event_usage_before_the_first_rollup_is_counted_from_raw_events(self):
+        org, team, _ = self.create_org_team_user()
+
+        # Only March 5th to 8th have been rolled up (e.g. the first rollup ran on the 6th)
+        with freeze_time("2020-03-02T10:00:00"):
+            self.event_factory(team, 3)
+        with freeze_time("2020-03-06T10:00:00"):
+            self.event_factory(team, 5)  # already rolled up, must not be counted twice
+        DailyTeamUsage.objects.create(team=team, date=datetime.date(2020, 3, 6), event_count=40)
+        DailyUsageRollup.objects.bulk_create(
+            [DailyUsageRollup(date=datetime.date(2020, 3, 5) + datetime.timedelta(days=i)) for i in range(0, 4)],
+        )
+        with freeze_time("2020-03-09T10:00:00"):
+            self.event_factory(team, 7)
+
+        self.assertEqual(get_monthly_event_usage(org), 50)
+
+        breakdown = get_event_usage_breakdown(org, datetime.date(2020, 3, 1), datetime.date(2020, 3, 9))
+        self.assertEqual(breakdown[0]["total"], 50)
+        self.assertEqual(
+            [day["events"] for day in breakdown[0]["usage"]], [0, 3, 0, 0, 0, 40, 0, 0, 7],
+        )
+
+    def test_monthly_event_usage_without_rollup(self):
+
+        org, team, _ = self.create_org_team_user()
+
+        with freeze_time("2020-04-02T10:00:00"):
+            self.event_factory(team, 6)
+
+        self.assertEqual(
+            get_monthly_event_usage(org, at_date=datetime.datetime(2020, 4, 15, tzinfo=pytz.UTC)), 6,
+        )
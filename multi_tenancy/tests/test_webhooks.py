@@ -1,13 +1,19 @@
 import datetime
+import json
+from io import StringIO
 from unittest.mock import MagicMock, patch
 
 import pytz
 import vcr
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import Client
 from django.utils import timezone
 from freezegun.api import freeze_time
-from multi_tenancy.models import OrganizationBilling, Plan
+from multi_tenancy.models import OrganizationBilling, Plan, StripeWebhookEvent
 from multi_tenancy.stripe import compute_webhook_signature
+from multi_tenancy.tasks import process_stripe_webhook_event
+from multi_tenancy.webhooks import handle_stripe_webhook_event
 from posthog.models import User
 from rest_framework import status
 
@@ -358,7 +364,7 @@ class TestPaymentSucceededWebhooks(StripeWebhookTestMixin):
         mock_capture.assert_not_called()
 
     @patch("posthoganalytics.capture")
-    @patch("multi_tenancy.views.capture_message")
+    @patch("multi_tenancy.webhooks.capture_message")
     def test_billing_period_not_updated_if_subscription_doesnt_match(self, mock_sentry_message, mock_capture):
         """
         Tests the edge case (in general should never happen) when we receive invoice.payment_succeeded but the
@@ -451,7 +457,7 @@ class TestPaymentSucceededWebhooks(StripeWebhookTestMixin):
             response = csrf_client.post(
                 "/billing/stripe_webhook", body, content_type="text/plain", HTTP_STRIPE_SIGNATURE=signature,
             )
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)  # event is accepted, but not applied
         instance.refresh_from_db()
         self.assertEqual(instance.billing_period_ends, current_period_end)  # billing period is not updated
 
@@ -464,7 +470,7 @@ class TestPaymentSucceededWebhooks(StripeWebhookTestMixin):
 
 class TestSpecialWebhookHandling(StripeWebhookTestMixin):
     @patch("posthoganalytics.capture")
-    @patch("multi_tenancy.views.cancel_payment_intent")
+    @patch("multi_tenancy.webhooks.cancel_payment_intent")
     @vcr.use_cassette(cassette_library_dir="multi_tenancy/tests/cassettes", filter_headers=["authorization"])
     def test_billing_period_special_handling_for_startup_plan(
         self, cancel_payment_intent, mock_capture,
@@ -563,7 +569,7 @@ class TestSpecialWebhookHandling(StripeWebhookTestMixin):
     @patch("posthoganalytics.capture")
     @patch("multi_tenancy.stripe._get_customer_id")
     @patch("multi_tenancy.stripe.stripe.Subscription.create")
-    @patch("multi_tenancy.views.cancel_payment_intent")
+    @patch("multi_tenancy.webhooks.cancel_payment_intent")
     @patch("stripe.Customer.modify")
     def test_handle_webhook_for_metered_plans_after_card_registration(
         self, set_default_pm, cancel_payment_intent, mock_session_create, mock_customer_id, mock_capture,
@@ -644,6 +650,7 @@ class TestSpecialWebhookHandling(StripeWebhookTestMixin):
             items=[{"price": "price_zyxwvu"}],
             trial_period_days=30,
             billing_cycle_anchor=datetime.datetime(2021, 1, 1, 23, 59, 59, 999999, tzinfo=pytz.UTC,),
+            idempotency_key="cus_MeteredI2MVxJI-price_zyxwvu",
         )
 
         # Check that the instance is correctly updated
@@ -668,6 +675,85 @@ class TestSpecialWebhookHandling(StripeWebhookTestMixin):
             "cus_MeteredI2MVxJI", invoice_settings={"default_payment_method": "pm_iEuIaI2h3ETxMVtRXS"}
         )
 
+    @patch("multi_tenancy.webhooks.report_card_validated")
+    @patch("multi_tenancy.webhooks.set_default_payment_method_for_customer")
+    @patch("multi_tenancy.webhooks.cancel_payment_intent")
+    @patch("multi_tenancy.models.create_subscription")
+    def test_subscription_is_only_created_once_if_card_validation_is_processed_again(
+        self, mock_create_subscription, *args,
+    ):
+        mock_create_subscription.return_value = {
+            "subscription_id": "sub_1234554321",
+            "subscription_item_id": "si_1a2b3c4d",
+            "customer_id": "cus_MeteredI2MVxJI",
+        }
+
+        organization, _, _ = self.create_org_team_user()
+        plan = Plan.objects.create(
+            key="metered", name="Metered Plan", price_id="price_zyxwvu", is_metered_billing=True,
+        )
+        OrganizationBilling.objects.create(
+            organization=organization, should_setup_billing=True, stripe_customer_id="cus_MeteredI2MVxJI", plan=plan,
+        )
+        event = {
+            "type": "payment_intent.amount_capturable_updated",
+            "data": {
+                "object": {
+                    "id": "pi_TxLb1HS1CyhnDR",
+                    "customer": "cus_MeteredI2MVxJI",
+                    "payment_method": "pm_iEuIaI2h3ETxMVtRXS",
+                },
+            },
+        }
+
+        # e.g. the webhook is retried after failing
+        handle_stripe_webhook_event(event)
+        handle_stripe_webhook_event(event)
+
+        mock_create_subscription.assert_called_once_with(price_id="price_zyxwvu", customer_id="cus_MeteredI2MVxJI")
+        instance = OrganizationBilling.objects.get(organization=organization)
+        self.assertEqual(instance.stripe_subscription_id, "sub_1234554321")
+        self.assertEqual(instance.should_setup_billing, False)
+
+    def test_cached_subscription_item_is_cleared_when_subscription_is_updated(self):
+        sample_webhook_secret: str = "wh_sec_test_abcdefghijklmnopqrstuvwxyz"
+
+        organization, _, _ = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization,
+            stripe_customer_id="cus_SubUpdatedI2MVx",
+            stripe_subscription_id="sub_I2MVxUpdated",
+            stripe_metered_subscription_item_id="si_metered_old",
+        )
+
+        body = """
+        {
+            "id": "evt_1IqSubUpdatedCyh3ETxLbC",
+            "object": "event",
+            "data": {
+                "object": {
+                    "id": "sub_I2MVxUpdated",
+                    "object": "subscription",
+                    "customer": "cus_SubUpdatedI2MVx",
+                    "status": "active"
+                }
+            },
+            "type": "customer.subscription.updated"
+        }
+        """
+
+        signature: str = self.generate_webhook_signature(body, sample_webhook_secret)
+
+        with self.settings(STRIPE_WEBHOOK_SECRET=sample_webhook_secret):
+            response = self.client.post(
+                "/billing/stripe_webhook", body, content_type="text/plain", HTTP_STRIPE_SIGNATURE=signature,
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "")
+        self.assertEqual(instance.stripe_subscription_id, "sub_I2MVxUpdated")  # nothing else changes
+
     @patch("multi_tenancy.views.capture_exception")
     def test_webhook_with_invalid_signature_fails(self, capture_exception):
         sample_webhook_secret: str = "wh_sec_test_abcdefghijklmnopqrstuvwxyz"
@@ -771,12 +857,13 @@ class TestSpecialWebhookHandling(StripeWebhookTestMixin):
         instance.refresh_from_db()
         self.assertEqual(instance.billing_period_ends, None)
 
-    @patch("multi_tenancy.views.capture_message")
+    @patch("multi_tenancy.webhooks.capture_message")
     def test_webhook_where_customer_cannot_be_located_is_logged(self, capture_message):
         sample_webhook_secret: str = "wh_sec_test_abcdefghijklmnopqrstuvwxyz"
 
         body: str = """
         {
+            "id": "evt_1H2FuICyh3ETxLbCUnknownCus",
             "data": {
                 "object": {
                     "id": "in_1H2FuFCyh3ETxLbCNarFj00f",
@@ -810,3 +897,465 @@ class TestSpecialWebhookHandling(StripeWebhookTestMixin):
         capture_message.assert_called_once_with(
             "Received invoice.payment_succeeded for cus_12345678 but customer is not in the database.",
         )
+
+    @patch("multi_tenancy.views.process_stripe_webhook_event.delay")
+    def test_webhook_is_stored_and_processed_asynchronously(self, mock_process_event):
+        sample_webhook_secret: str = "wh_sec_test_abcdefghijklmnopqrstuvwxyz"
+
+        organization, _, _ = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization,
+            stripe_customer_id="cus_AsyncI2MVx",
+            stripe_subscription_id="sub_AsyncI2MVx",
+            stripe_metered_subscription_item_id="si_metered_old",
+        )
+
+        body = """
+        {
+            "id": "evt_1IqAsyncCyh3ETxLbC",
+            "object": "event",
+            "data": {
+                "object": {
+                    "id": "sub_AsyncI2MVx",
+                    "object": "subscription",
+                    "customer": "cus_AsyncI2MVx"
+                }
+            },
+            "type": "customer.subscription.updated"
+        }
+        """
+
+        signature: str = self.generate_webhook_signature(body, sample_webhook_secret)
+
+        with self.settings(STRIPE_WEBHOOK_SECRET=sample_webhook_secret):
+            response = self.client.post(
+                "/billing/stripe_webhook", body, content_type="text/plain", HTTP_STRIPE_SIGNATURE=signature,
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Event is stored as received, but not processed within the request
+        webhook_event = StripeWebhookEvent.objects.get()
+        self.assertEqual(webhook_event.type, "customer.subscription.updated")
+        self.assertEqual(webhook_event.payload, body)
+        self.assertEqual(webhook_event.processed_at, None)
+        mock_process_event.assert_called_once_with(webhook_event_id=webhook_event.pk)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "si_metered_old")
+
+        process_stripe_webhook_event(webhook_event_id=webhook_event.pk)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "")
+        webhook_event.refresh_from_db()
+        self.assertEqual(webhook_event.status, StripeWebhookEvent.PROCESSED)
+        self.assertIsNotNone(webhook_event.processed_at)
+
+    @patch("multi_tenancy.tasks.update_subscription_billing_period.delay")
+    def test_duplicate_webhook_deliveries_are_only_processed_once(self, mock_update_billing_period):
+        sample_webhook_secret: str = "wh_sec_test_abcdefghijklmnopqrstuvwxyz"
+
+        organization, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization, should_setup_billing=True, stripe_customer_id="cus_DuplicateI2MVx",
+        )
+
+        body = """
+        {
+            "id": "evt_1IqDuplicateCyh3ETxLbC",
+            "object": "event",
+            "data": {
+                "object": {
+                    "id": "in_1IqDuplicateCyh3ETxLbC",
+                    "customer": "cus_DuplicateI2MVx",
+                    "subscription": "sub_DuplicateI2MVx"
+                }
+            },
+            "type": "invoice.payment_succeeded"
+        }
+        """
+
+        with self.settings(STRIPE_WEBHOOK_SECRET=sample_webhook_secret):
+            for _ in range(0, 3):  # Stripe retries the delivery
+                response = self.client.post(
+                    "/billing/stripe_webhook",
+                    body,
+                    content_type="text/plain",
+                    HTTP_STRIPE_SIGNATURE=self.generate_webhook_signature(body, sample_webhook_secret),
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(StripeWebhookEvent.objects.get().status, StripeWebhookEvent.PROCESSED)
+        mock_update_billing_period.assert_called_once()
+
+        # An event that is already being processed is not processed again
+        webhook_event = StripeWebhookEvent.objects.get()
+        StripeWebhookEvent.objects.filter(pk=webhook_event.pk).update(status=StripeWebhookEvent.PROCESSING)
+        process_stripe_webhook_event(webhook_event_id=webhook_event.pk)
+        mock_update_billing_period.assert_called_once()
+
+    @patch("multi_tenancy.tasks.update_subscription_billing_period.delay")
+    def test_webhook_is_processed_on_redelivery_if_it_could_not_be_queued(self, mock_update_billing_period):
+        organization, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization, should_setup_billing=True, stripe_customer_id="cus_UnqueuedI2MVx",
+        )
+
+        body = """
+        {
+            "id": "evt_1IqUnqueuedCyh3ETxLbC",
+            "object": "event",
+            "data": {
+                "object": {
+                    "id": "in_1IqUnqueuedCyh3ETxLbC",
+                    "customer": "cus_UnqueuedI2MVx",
+                    "subscription": "sub_UnqueuedI2MVx"
+                }
+            },
+            "type": "invoice.payment_succeeded"
+        }
+        """
+
+        with patch(
+            "multi_tenancy.views.process_stripe_webhook_event.delay", side_effect=ConnectionError("Broker is down"),
+        ):
+            with self.assertRaises(ConnectionError):
+                self._post_webhook(body)  # Stripe receives an error and delivers the event again
+
+        self.assertEqual(StripeWebhookEvent.objects.get().status, StripeWebhookEvent.PENDING)
+
+        response = self._post_webhook(body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(StripeWebhookEvent.objects.get().status, StripeWebhookEvent.PROCESSED)
+        mock_update_billing_period.assert_called_once()
+
+    def _post_webhook(self, body: str):
+        sample_webhook_secret: str = "wh_sec_test_abcdefghijklmnopqrstuvwxyz"
+
+        with self.settings(STRIPE_WEBHOOK_SECRET=sample_webhook_secret):
+            return self.client.post(
+                "/billing/stripe_webhook",
+                body,
+                content_type="text/plain",
+                HTTP_STRIPE_SIGNATURE=self.generate_webhook_signature(body, sample_webhook_secret),
+            )
+
+    @patch("multi_tenancy.webhooks.capture_message")
+    def test_webhook_with_unhandled_event_type_is_ignored(self, mock_sentry_message):
+        body = """
+        {
+            "id": "evt_1IqUnhandledCyh3ETxLbC",
+            "object": "event",
+            "data": {"object": {"id": "cus_UnhandledI2MVx", "object": "customer"}},
+            "type": "customer.created"
+        }
+        """
+
+        response = self._post_webhook(body)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(StripeWebhookEvent.objects.count(), 0)  # event is not even stored
+        mock_sentry_message.assert_not_called()
+
+    def test_subscription_is_cleared_when_subscription_is_deleted(self):
+        organization, _, _ = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization,
+            plan=Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True),
+            stripe_customer_id="cus_DeletedI2MVx",
+            stripe_subscription_id="sub_DeletedI2MVx",
+            stripe_metered_subscription_item_id="si_metered",
+            billing_period_ends=timezone.datetime(2021, 6, 1, tzinfo=pytz.UTC),
+        )
+
+        body = """
+        {
+            "id": "evt_1IqSubDeletedCyh3ETxLbC",
+            "object": "event",
+            "data": {
+                "object": {
+                    "id": "sub_DeletedI2MVx",
+                    "object": "subscription",
+                    "customer": "cus_DeletedI2MVx",
+                    "ended_at": 1620648000,
+                    "status": "canceled"
+                }
+            },
+            "type": "customer.subscription.deleted"
+        }
+        """
+
+        response = self._post_webhook(body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_subscription_id, "")
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "")
+        self.assertEqual(
+            instance.billing_period_ends, timezone.datetime(2021, 5, 10, 12, tzinfo=pytz.UTC),
+        )  # billing ends when the subscription ended
+
+    @patch("multi_tenancy.webhooks.capture_message")
+    @patch("multi_tenancy.webhooks.get_subscription")
+    @patch("multi_tenancy.webhooks.update_subscription_billing_period.delay")
+    def test_deleted_subscription_is_not_reattached_by_its_final_invoice(
+        self, mock_update_billing_period, mock_get_subscription, mock_capture_message,
+    ):
+        mock_get_subscription.return_value = {"id": "sub_DeletedI2MVx", "status": "canceled", "ended_at": 1620648000}
+        organization, _, _ = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization,
+            plan=Plan.objects.create(key="metered", name="Metered", price_id="m1", is_metered_billing=True),
+            stripe_customer_id="cus_DeletedI2MVx",
+            stripe_subscription_id="sub_DeletedI2MVx",
+            billing_period_ends=timezone.datetime(2021, 6, 1, tzinfo=pytz.UTC),
+        )
+
+        self._post_webhook(
+            """
+            {
+                "id": "evt_1IqSubDeletedCyh3ETxLbC",
+                "object": "event",
+                "data": {
+                    "object": {
+                        "id": "sub_DeletedI2MVx",
+                        "object": "subscription",
+                        "customer": "cus_DeletedI2MVx",
+                        "ended_at": 1620648000,
+                        "status": "canceled"
+                    }
+                },
+                "type": "customer.subscription.deleted"
+            }
+            """
+        )
+
+        # The final invoice of the (metered) subscription is paid afterwards
+        response = self._post_webhook(
+            """
+            {
+                "id": "evt_1IqFinalInvoiceCyh3ETxLbC",
+                "object": "event",
+                "data": {
+                    "object": {
+                        "id": "in_1IqFinalInvoiceCyh3ETx",
+                        "object": "invoice",
+                        "customer": "cus_DeletedI2MVx",
+                        "subscription": "sub_DeletedI2MVx"
+                    }
+                },
+                "type": "invoice.payment_succeeded"
+            }
+            """
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_subscription_id, "")
+        self.assertEqual(
+            instance.billing_period_ends, timezone.datetime(2021, 5, 10, 12, tzinfo=pytz.UTC),
+        )  # billing is not extended
+        mock_update_billing_period.assert_not_called()
+        mock_get_subscription.assert_called_once_with("sub_DeletedI2MVx", retry_on_rate_limit=True)
+        mock_capture_message.assert_called_once()
+
+    @patch("multi_tenancy.webhooks.get_subscription")
+    @patch("multi_tenancy.webhooks.update_subscription_billing_period.delay")
+    def test_subscription_is_recorded_for_organizations_that_subscribed_before_it_was_stored(
+        self, mock_update_billing_period, mock_get_subscription,
+    ):
+        mock_get_subscription.return_value = {"id": "sub_LegacyI2MVx", "status": "active", "ended_at": None}
+        organization, _, _ = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization,
+            plan=Plan.objects.create(key="standard", name="Standard", price_id="p1"),
+            stripe_customer_id="cus_LegacyI2MVx",
+            should_setup_billing=False,
+            billing_period_ends=timezone.datetime(2021, 5, 1, tzinfo=pytz.UTC),
+        )  # the subscription ID wasn't stored at the time
+
+        response = self._post_webhook(
+            """
+            {
+                "id": "evt_1IqLegacyInvoiceCyh3ETxLb",
+                "object": "event",
+                "data": {
+                    "object": {
+                        "id": "in_1IqLegacyInvoiceCyh3ETx",
+                        "object": "invoice",
+                        "customer": "cus_LegacyI2MVx",
+                        "subscription": "sub_LegacyI2MVx"
+                    }
+                },
+                "type": "invoice.payment_succeeded"
+            }
+            """
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_subscription_id, "sub_LegacyI2MVx")
+        mock_update_billing_period.assert_called_once_with(organization_id=organization.id)
+
+    @patch("posthoganalytics.capture")
+    def test_failed_invoice_payment_is_reported(self, mock_capture):
+        organization, _, user = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization, stripe_customer_id="cus_FailedI2MVx", stripe_subscription_id="sub_FailedI2MVx",
+        )
+
+        body = """
+        {
+            "id": "evt_1IqPaymentFailedCyh3ETxLbC",
+            "object": "event",
+            "data": {
+                "object": {
+                    "id": "in_1IqPaymentFailedCyh3ETxLbC",
+                    "object": "invoice",
+                    "customer": "cus_FailedI2MVx",
+                    "subscription": "sub_FailedI2MVx",
+                    "attempt_count": 2
+                }
+            },
+            "type": "invoice.payment_failed"
+        }
+        """
+
+        response = self._post_webhook(body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        mock_capture.assert_called_once_with(
+            user.distinct_id,
+            "billing payment failed",
+            {
+                "plan_key": None,
+                "billing_period_ends": None,
+                "organization_id": str(organization.id),
+                "attempt_count": 2,
+            },
+        )
+
+
+class TestReplayWebhooks(StripeWebhookTestMixin):
+    def _create_webhook_event(self, stripe_event_id: str, customer_id: str, **kwargs) -> StripeWebhookEvent:
+        payload = {
+            "id": stripe_event_id,
+            "object": "event",
+            "data": {"object": {"id": "sub_ReplayI2MVx", "object": "subscription", "customer": customer_id}},
+            "type": "customer.subscription.updated",
+        }
+        return StripeWebhookEvent.objects.create(
+            stripe_event_id=stripe_event_id, type=payload["type"], payload=json.dumps(payload), **kwargs,
+        )
+
+    def test_replay_failed_webhook_events_from_local_log(self):
+        organization, _, _ = self.create_org_team_user()
+        instance: OrganizationBilling = OrganizationBilling.objects.create(
+            organization=organization,
+            stripe_customer_id="cus_ReplayI2MVx",
+            stripe_subscription_id="sub_ReplayI2MVx",
+            stripe_metered_subscription_item_id="si_metered_old",
+        )
+        failed_event = self._create_webhook_event("evt_failed", "cus_ReplayI2MVx", status=StripeWebhookEvent.FAILED)
+        processed_event = self._create_webhook_event(
+            "evt_processed", "cus_ReplayI2MVx", status=StripeWebhookEvent.PROCESSED,
+        )
+        since = (timezone.now() - datetime.timedelta(hours=1)).isoformat()
+
+        # Dry run does not process anything
+        out = StringIO()
+        call_command("replay_stripe_webhooks", "--since", since, "--dry-run", stdout=out)
+        self.assertIn("Would replay evt_failed", out.getvalue())
+        self.assertNotIn("evt_processed", out.getvalue())
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "si_metered_old")
+
+        out = StringIO()
+        call_command("replay_stripe_webhooks", "--since", since, "--concurrency", "1", stdout=out)
+        self.assertIn("Processed: 1. Failed: 0. Skipped: 0.", out.getvalue())
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.stripe_metered_subscription_item_id, "")
+        failed_event.refresh_from_db()
+        self.assertEqual(failed_event.status, StripeWebhookEvent.PROCESSED)
+        processed_event.refresh_from_db()
+        self.assertEqual(processed_event.processed_at, None)  # not processed again
+
+    def test_replay_abandoned_webhook_events_from_local_log(self):
+        organization, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization,
+            stripe_customer_id="cus_ReplayI2MVx",
+            stripe_subscription_id="sub_ReplayI2MVx",
+            stripe_metered_subscription_item_id="si_metered_old",
+        )
+        abandoned_event = self._create_webhook_event(
+            "evt_abandoned",
+            "cus_ReplayI2MVx",
+            status=StripeWebhookEvent.PROCESSING,
+            processing_started_at=timezone.now() - datetime.timedelta(hours=2),  # e.g. the worker died
+        )
+        processing_event = self._create_webhook_event(
+            "evt_processing",
+            "cus_ReplayI2MVx",
+            status=StripeWebhookEvent.PROCESSING,
+            processing_started_at=timezone.now() - datetime.timedelta(minutes=1),
+        )
+        since = (timezone.now() - datetime.timedelta(hours=1)).isoformat()
+
+        out = StringIO()
+        call_command("replay_stripe_webhooks", "--since", since, "--dry-run", stdout=out)
+        self.assertIn("Would replay evt_abandoned", out.getvalue())
+        self.assertNotIn("evt_processing", out.getvalue())  # still being processed
+
+        out = StringIO()
+        call_command("replay_stripe_webhooks", "--since", since, "--concurrency", "1", stdout=out)
+        self.assertIn("Processed: 1. Failed: 0. Skipped: 0.", out.getvalue())
+
+        abandoned_event.refresh_from_db()
+        self.assertEqual(abandoned_event.status, StripeWebhookEvent.PROCESSED)
+        processing_event.refresh_from_db()
+        self.assertEqual(processing_event.status, StripeWebhookEvent.PROCESSING)
+
+    @patch("multi_tenancy.management.commands.replay_stripe_webhooks.list_events")
+    def test_replay_missed_webhook_events_from_stripe(self, mock_list_events):
+        organization, _, _ = self.create_org_team_user()
+        OrganizationBilling.objects.create(
+            organization=organization, stripe_customer_id="cus_ReplayI2MVx", stripe_subscription_id="sub_ReplayI2MVx",
+        )
+        self._create_webhook_event("evt_received", "cus_ReplayI2MVx", status=StripeWebhookEvent.PROCESSED)
+        mock_list_events.return_value = iter(
+            [
+                {
+                    "id": stripe_event_id,
+                    "created": 1620000000,
+                    "data": {"object": {"id": "sub_ReplayI2MVx", "customer": "cus_ReplayI2MVx"}},
+                    "type": "customer.subscription.updated",
+                }
+                for stripe_event_id in ["evt_missed", "evt_received"]
+            ]
+        )
+
+        out = StringIO()
+        call_command(
+            "replay_stripe_webhooks",
+            "--source",
+            "stripe",
+            "--since",
+            "2021-05-01T00:00:00Z",
+            "--until",
+            "2021-05-04T00:00:00Z",
+            "--concurrency",
+            "1",
+            stdout=out,
+        )
+
+        self.assertEqual(mock_list_events.call_args.kwargs["since"].isoformat(), "2021-05-01T00:00:00+00:00")
+        self.assertIn("Skipped evt_received", out.getvalue())  # event received before is skipped
+        self.assertIn("Processed: 1. Failed: 0. Skipped: 1.", out.getvalue())
+        self.assertEqual(StripeWebhookEvent.objects.get(stripe_event_id="evt_missed").status, "processed")
+
+    def test_replay_requires_a_valid_time_window(self):
+        with self.assertRaises(CommandError):
+            call_command("replay_stripe_webhooks", "--since", "2021-05-04", "--until", "2021-05-01")
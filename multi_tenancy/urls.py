@@ -6,6 +6,7 @@ from posthog.urls import urlpatterns as posthog_urls
 
 from .views import (
     BillingSubscribeViewset,
+    BillingUsageViewset,
     BillingViewset,
     MultiTenancyOrgSignupViewset,
     PlanViewset,
@@ -26,10 +27,11 @@ urlpatterns: List = [
     opt_slash_path("api/plans", PlanViewset.as_view({"get": "list"}), name="billing_plans"),
     path("api/plans/<str:key>/template/", plan_template, name="billing_plan_template"),
     path("api/plans/<str:key>", PlanViewset.as_view({"get": "retrieve"}), name="billing_plan"),
+    opt_slash_path("api/billing/usage", BillingUsageViewset.as_view({"get": "list"}), name="billing_usage"),
     opt_slash_path("api/billing", BillingViewset.as_view({"get": "retrieve"}), name="billing"),
     opt_slash_path(
         "billing/setup", stripe_checkout_view, name="billing_setup",
-    ),  # Redirect to Stripe Checkout to set-up billing (requires session ID)
+    ),  # Redirect to Stripe Checkout to set-up billing (creates the checkout session if no session ID is passed)
     opt_slash_path(
         "billing/manage", stripe_billing_portal, name="billing_manage",
     ),  # Redirect to Stripe Customer Portal to manage subscription
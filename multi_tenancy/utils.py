@@ -1,16 +1,35 @@
 import calendar
 import datetime
-from typing import Optional, Tuple
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional, Set, Tuple, Union
+from uuid import UUID
 
 import pytz
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Max, Sum
 from django.utils import timezone
 from ee.clickhouse.client import sync_execute
-from posthog.models import Organization, Team
+from posthog.models import Organization, Team, User
+from sentry_sdk import capture_exception
+
+from multi_tenancy.stripe import get_current_usage_bill
+
+from .models import DailyTeamUsage, DailyUsageRollup, OrganizationBilling
 
 EVENT_USAGE_CACHING_TTL: int = settings.EVENT_USAGE_CACHING_TTL
+EVENT_USAGE_FULL_RECOUNT_INTERVAL: int = settings.EVENT_USAGE_FULL_RECOUNT_INTERVAL
+EVENT_USAGE_REFRESH_LOCK_TIMEOUT: int = 5 * 60  # max time a single refresh is expected to take
+EVENT_USAGE_REFRESH_WAIT_ATTEMPTS: int = 8  # times a worker checks for the result of a refresh by another worker
+EVENT_USAGE_REFRESH_WAIT_INTERVAL: float = 0.25
+CURRENT_BILL_CACHING_TTL: int = settings.CURRENT_BILL_CACHING_TTL
+CURRENT_BILL_STALE_TTL: int = 24 * 60 * 60  # expired amounts are still returned while they're refreshed
+CURRENT_BILL_REFRESH_LOCK_TIMEOUT: int = 60
+EVENT_USAGE_BREAKDOWN_CACHING_TTL: int = 5 * 60  # for date ranges that include today (i.e. still changing)
+EVENT_QUOTA_TTL: int = 60 * 60  # quotas that are not refreshed expire, so limits are never enforced on stale data
+CURRENT_TEAM_CACHING_TTL: int = 24 * 60 * 60
 
 
 def get_event_usage_for_timerange(
@@ -22,18 +41,32 @@ def get_event_usage_for_timerange(
     Returns the number of events ingested in the time range (inclusive) for all
     teams of the organization. Intended mainly for billing purposes.
     """
+    return _get_event_usage(organization=organization, start_time=start_time, end_time=end_time)
+
+
+def get_event_usage_after(
+    organization: Organization, after_time: datetime.datetime, end_time: datetime.datetime,
+) -> Optional[int]:
+    """
+    Returns the number of events with a timestamp strictly after `after_time` and until `end_time` (inclusive) for
+    all teams of the organization. Used to count usage incrementally from a watermark.
+    """
+    return _get_event_usage(organization=organization, start_time=after_time, end_time=end_time, inclusive_start=False)
+
 
+def _get_event_usage(
+    organization: Organization,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    inclusive_start: bool = True,
+) -> Optional[int]:
     result = sync_execute(
         "SELECT count(1) FROM events where team_id IN %(team_ids)s AND timestamp"
-        " >= %(date_from)s AND timestamp <= %(date_to)s",
+        f" {'>=' if inclusive_start else '>'} %(date_from)s AND timestamp <= %(date_to)s",
         {
             "date_from": start_time.strftime("%Y-%m-%d %H:%M:%S"),
             "date_to": end_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "team_ids": list(
-                Team.objects.filter(organization=organization).values_list(
-                    "id", flat=True,
-                ),
-            ),
+            "team_ids": list(Team.objects.filter(organization=organization).values_list("id", flat=True)),
         },
     )
 
@@ -43,6 +76,307 @@ def get_event_usage_for_timerange(
     return None  # in case CH is not available (mainly to run posthog tests)
 
 
+def get_teams_event_usage_for_timerange(
+    start_time: datetime.datetime, end_time: datetime.datetime, team_ids: Optional[List[int]] = None,
+) -> Optional[Dict[int, int]]:
+    """
+    Returns the number of events ingested in the time range (inclusive) grouped by team, using a single query. If
+    `team_ids` is not provided, usage is computed for all teams. Teams without any events are not included.
+    """
+
+    if team_ids is not None and not team_ids:
+        return {}
+
+    team_filter: str = "team_id IN %(team_ids)s AND " if team_ids is not None else ""
+
+    result = sync_execute(
+        f"SELECT team_id, count(1) FROM events WHERE {team_filter}timestamp >= %(date_from)s"
+        " AND timestamp <= %(date_to)s GROUP BY team_id",
+        {
+            "date_from": start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "date_to": end_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "team_ids": team_ids,
+        },
+    )
+
+    if result is None:
+        return None  # in case CH is not available (mainly to run posthog tests)
+
+    return {team_id: count for team_id, count in result}
+
+
+def get_organizations_event_usage_for_timerange(
+    organization_ids: List[str], start_time: datetime.datetime, end_time: datetime.datetime,
+) -> Optional[Dict[str, int]]:
+    """
+    Returns the number of events ingested in the time range (inclusive) for each of the organizations provided. Runs
+    a single grouped query for all the teams of the organizations and maps the results back in memory.
+    """
+
+    team_organizations: Dict[int, str] = {
+        team_id: str(organization_id)
+        for team_id, organization_id in Team.objects.filter(organization_id__in=organization_ids).values_list(
+            "id", "organization_id",
+        )
+    }
+
+    team_usage = get_teams_event_usage_for_timerange(
+        start_time=start_time, end_time=end_time, team_ids=list(team_organizations.keys()),
+    )
+
+    if team_usage is None:
+        return None
+
+    usage: Dict[str, int] = {str(organization_id): 0 for organization_id in organization_ids}
+    for team_id, count in team_usage.items():
+        usage[team_organizations[team_id]] += count
+
+    return usage
+
+
+def get_teams_daily_event_usage_for_timerange(
+    start_time: datetime.datetime, end_time: datetime.datetime, team_ids: List[int],
+) -> Optional[List[Tuple[int, datetime.date, int]]]:
+    """
+    Returns the number of events ingested in the time range (inclusive) by each team on each day as
+    `(team_id, date, count)` tuples, using a single grouped query. Days without any events are not included.
+    """
+
+    if not team_ids:
+        return []
+
+    result = sync_execute(
+        "SELECT team_id, toDate(timestamp), count(1) FROM events WHERE team_id IN %(team_ids)s"
+        " AND timestamp >= %(date_from)s AND timestamp <= %(date_to)s GROUP BY team_id, toDate(timestamp)",
+        {
+            "date_from": start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "date_to": end_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "team_ids": team_ids,
+        },
+    )
+
+    if result is None:
+        return None  # in case CH is not available (mainly to run posthog tests)
+
+    return [(team_id, date, count) for team_id, date, count in result]
+
+
+def get_event_usage_breakdown(
+    organization: Organization, date_from: datetime.date, date_to: datetime.date,
+) -> Optional[List[Dict]]:
+    """
+    Returns the number of events ingested by each team of the organization on each day of the date range (inclusive).
+    Days that have already been rolled up are read from `DailyTeamUsage`; the remaining days (before and after the
+    rolled up days) are counted from raw events with a grouped query each.
+    """
+
+    teams: List[Tuple[int, str]] = list(
+        Team.objects.filter(organization=organization).order_by("id").values_list("id", "name"),
+    )
+    usage: Dict[int, Dict[datetime.date, int]] = {team_id: {} for team_id, _ in teams}
+
+    rollup_date_range, raw_time_ranges = _split_time_range_by_rollup(
+        start_time=datetime.datetime.combine(date_from, datetime.time.min).replace(tzinfo=pytz.UTC),
+        end_time=datetime.datetime.combine(date_to, datetime.time.max).replace(tzinfo=pytz.UTC),
+    )
+
+    if rollup_date_range:
+        for team_id, date, event_count in DailyTeamUsage.objects.filter(
+            team_id__in=usage.keys(), date__gte=rollup_date_range[0], date__lte=rollup_date_range[1],
+        ).values_list("team_id", "date", "event_count"):
+            usage[team_id][date] = event_count
+
+    for start_time, end_time in raw_time_ranges:
+        raw_usage = get_teams_daily_event_usage_for_timerange(
+            start_time=start_time, end_time=end_time, team_ids=list(usage.keys()),
+        )
+
+        if raw_usage is None:
+            return None
+
+        for team_id, date, event_count in raw_usage:
+            if team_id in usage:
+                usage[team_id][date] = event_count
+
+    dates: List[datetime.date] = [
+        date_from + datetime.timedelta(days=i) for i in range(0, (date_to - date_from).days + 1)
+    ]
+
+    return [
+        {
+            "id": team_id,
+            "name": name,
+            "total": sum(usage[team_id].values()),
+            "usage": [{"date": date, "events": usage[team_id].get(date, 0)} for date in dates],
+        }
+        for team_id, name in teams
+    ]
+
+
+def get_cached_event_usage_breakdown(
+    organization: Organization, date_from: datetime.date, date_to: datetime.date,
+) -> Optional[List[Dict]]:
+    """
+    Cached version of `get_event_usage_breakdown`. Date ranges in the past are cached for `EVENT_USAGE_CACHING_TTL`,
+    ranges that include today only for a few minutes.
+    """
+
+    cache_key: str = f"usage_breakdown_{organization.id}_{date_from.isoformat()}_{date_to.isoformat()}"
+    cached_result: Optional[List[Dict]] = cache.get(cache_key)
+
+    if cached_result is not None:
+        return cached_result
+
+    result = get_event_usage_breakdown(organization=organization, date_from=date_from, date_to=date_to)
+
+    if result is None:
+        # Don't cache unavailable/error result
+        return result
+
+    cache.set(
+        cache_key,
+        result,
+        EVENT_USAGE_CACHING_TTL if date_to < timezone.now().date() else EVENT_USAGE_BREAKDOWN_CACHING_TTL,
+    )
+
+    return result
+
+
+def get_last_rolled_up_date() -> Optional[datetime.date]:
+    """
+    Returns the last day for which the daily team usage has been rolled up (see `DailyTeamUsage`).
+    """
+    return DailyUsageRollup.objects.aggregate(Max("date"))["date__max"]
+
+
+def _split_time_range_by_rollup(
+    start_time: datetime.datetime, end_time: datetime.datetime,
+) -> Tuple[Optional[Tuple[datetime.date, datetime.date]], List[Tuple[datetime.datetime, datetime.datetime]]]:
+    """
+    Splits a time range into the (latest) range of consecutive full days that can be read from `DailyTeamUsage`, if
+    any, and the time ranges that have to be counted from raw events. Days that haven't been rolled up (e.g. before
+    the first rollup) are always counted from raw events.
+    """
+
+    first_full_date: datetime.date = (
+        start_time.date() if start_time.time() == datetime.time.min else start_time.date() + datetime.timedelta(days=1)
+    )
+    last_full_date: datetime.date = (
+        end_time.date()
+        if end_time.time() >= datetime.time(23, 59, 59)
+        else end_time.date() - datetime.timedelta(days=1)
+    )
+
+    rolled_up_dates: Set[datetime.date] = (
+        set(
+            DailyUsageRollup.objects.filter(date__gte=first_full_date, date__lte=last_full_date).values_list(
+                "date", flat=True,
+            ),
+        )
+        if first_full_date <= last_full_date
+        else set()
+    )
+
+    if not rolled_up_dates:
+        return None, [(start_time, end_time)]
+
+    rollup_end_date: datetime.date = max(rolled_up_dates)
+    rollup_start_date: datetime.date = rollup_end_date
+    while rollup_start_date - datetime.timedelta(days=1) in rolled_up_dates:
+        rollup_start_date -= datetime.timedelta(days=1)
+
+    raw_time_ranges: List[Tuple[datetime.datetime, datetime.datetime]] = []
+
+    if rollup_start_date > start_time.date():
+        raw_time_ranges.append(
+            (
+                start_time,
+                datetime.datetime.combine(rollup_start_date - datetime.timedelta(days=1), datetime.time.max).replace(
+                    tzinfo=start_time.tzinfo,
+                ),
+            ),
+        )
+
+    remainder_start_time: datetime.datetime = datetime.datetime.combine(
+        rollup_end_date + datetime.timedelta(days=1), datetime.time.min,
+    ).replace(tzinfo=start_time.tzinfo)
+
+    if remainder_start_time <= end_time:
+        raw_time_ranges.append((remainder_start_time, end_time))
+
+    return (rollup_start_date, rollup_end_date), raw_time_ranges
+
+
+def get_event_usage_with_rollup(
+    organization: Organization, start_time: datetime.datetime, end_time: datetime.datetime,
+) -> Optional[int]:
+    """
+    Same as `get_event_usage_for_timerange` but full days that have already been rolled up are read from
+    `DailyTeamUsage`; only the remainder of the time range is counted from raw events.
+    """
+
+    rollup_date_range, raw_time_ranges = _split_time_range_by_rollup(start_time, end_time)
+    usage: int = 0
+
+    if rollup_date_range:
+        usage += (
+            DailyTeamUsage.objects.filter(
+                team__organization=organization, date__gte=rollup_date_range[0], date__lte=rollup_date_range[1],
+            ).aggregate(Sum("event_count"))["event_count__sum"]
+            or 0
+        )
+
+    for raw_start_time, raw_end_time in raw_time_ranges:
+        raw_usage = get_event_usage_for_timerange(
+            organization=organization, start_time=raw_start_time, end_time=raw_end_time,
+        )
+
+        if raw_usage is None:
+            return None
+
+        usage += raw_usage
+
+    return usage
+
+
+def get_organizations_event_usage_with_rollup(
+    organization_ids: List[str], start_time: datetime.datetime, end_time: datetime.datetime,
+) -> Optional[Dict[str, int]]:
+    """
+    Same as `get_organizations_event_usage_for_timerange` but full days that have already been rolled up are read
+    from `DailyTeamUsage` (see `get_event_usage_with_rollup`).
+    """
+
+    rollup_date_range, raw_time_ranges = _split_time_range_by_rollup(start_time, end_time)
+    usage: Dict[str, int] = {str(organization_id): 0 for organization_id in organization_ids}
+
+    if rollup_date_range:
+        for organization_id, event_count in (
+            DailyTeamUsage.objects.filter(
+                team__organization_id__in=organization_ids,
+                date__gte=rollup_date_range[0],
+                date__lte=rollup_date_range[1],
+            )
+            .values("team__organization_id")
+            .annotate(event_count=Sum("event_count"))
+            .values_list("team__organization_id", "event_count")
+        ):
+            usage[str(organization_id)] += event_count
+
+    for raw_start_time, raw_end_time in raw_time_ranges:
+        raw_usage = get_organizations_event_usage_for_timerange(
+            organization_ids=organization_ids, start_time=raw_start_time, end_time=raw_end_time,
+        )
+
+        if raw_usage is None:
+            return None
+
+        for organization_id, event_count in raw_usage.items():
+            usage[organization_id] += event_count
+
+    return usage
+
+
 def get_monthly_event_usage(
     organization: Organization, at_date: datetime.datetime = None,
 ) -> int:
@@ -62,14 +396,19 @@ def get_monthly_event_usage(
         datetime.time.max,
     ).replace(tzinfo=pytz.UTC)
 
-    return get_event_usage_for_timerange(
+    return get_event_usage_with_rollup(
         organization=organization, start_time=start_time, end_time=end_time
     )
 
 
-def get_cached_monthly_event_usage(organization: Organization) -> int:
+def get_cached_monthly_event_usage(organization: Organization) -> Optional[int]:
     """
-    Returns the cached number of events used in the current calendar month. Results will be cached for 12 hours.
+    Returns the cached number of events used in the current calendar month. Results will be cached for 12 hours; when
+    they expire, usage is refreshed incrementally (see `refresh_monthly_event_usage`).
+
+    Only one worker refreshes the usage of an organization at a time. If a previous (stale) result for the current
+    month exists, it is returned right away and usage is refreshed in the background. Otherwise, workers that didn't
+    get to refresh the usage wait briefly for the result (and count the usage without caching it if it's not ready).
     """
 
     cache_key: str = f"monthly_usage_{organization.id}"
@@ -78,28 +417,287 @@ def get_cached_monthly_event_usage(organization: Organization) -> int:
     if cached_result is not None:
         return cached_result
 
+    counter: Optional[Dict] = cache.get(f"monthly_usage_counter_{organization.id}")
+    stale_result: Optional[int] = (
+        counter["total"] if counter and counter["start_of_month"] == _get_start_of_month(timezone.now()) else None
+    )
+
+    if not cache.add(_get_refresh_lock_key(organization.id), True, EVENT_USAGE_REFRESH_LOCK_TIMEOUT):
+        # Another worker is already refreshing the usage
+        if stale_result is not None:
+            return stale_result
+
+        for _ in range(0, EVENT_USAGE_REFRESH_WAIT_ATTEMPTS):
+            time.sleep(EVENT_USAGE_REFRESH_WAIT_INTERVAL)
+            cached_result = cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+
+        return get_monthly_event_usage(organization)
+
+    if stale_result is not None:
+        from multi_tenancy.tasks import refresh_monthly_event_usage_for_organization  # tasks depend on `utils`
+
+        try:
+            refresh_monthly_event_usage_for_organization.delay(organization_id=str(organization.id))
+        except Exception as e:
+            # The task won't release the lock (e.g. the broker is unavailable)
+            release_monthly_event_usage_refresh_lock(organization.id)
+            capture_exception(e)
+
+        return stale_result
+
+    try:
+        return refresh_monthly_event_usage(organization)
+    finally:
+        release_monthly_event_usage_refresh_lock(organization.id)
+
+
+def release_monthly_event_usage_refresh_lock(organization_id: Union[str, UUID]) -> None:
+    cache.delete(_get_refresh_lock_key(organization_id))
+
+
+def _get_refresh_lock_key(organization_id: Union[str, UUID]) -> str:
+    return f"monthly_usage_refresh_lock_{organization_id}"
+
+
+def _get_start_of_month(at_date: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime.combine(
+        datetime.datetime(at_date.year, at_date.month, 1), datetime.time.min,
+    ).replace(tzinfo=pytz.UTC)
+
+
+def _get_usage_watermark(now: datetime.datetime) -> datetime.datetime:
+    # Timestamps are compared with a precision of seconds, round up so all events up until now are included
+    return min(
+        (now + datetime.timedelta(microseconds=999999)).replace(microsecond=0),
+        _get_start_of_month(now) + relativedelta(months=+1) - datetime.timedelta(seconds=1),
+    )
+
+
+def _set_cached_monthly_event_usage(
+    usage: Dict[str, int], now: datetime.datetime, watermark: datetime.datetime, recount_at: datetime.datetime,
+) -> None:
+    """
+    Caches the monthly event usage (and the incremental counter) of multiple organizations at once.
+    """
+
+    start_of_month: datetime.datetime = _get_start_of_month(now)
+    seconds_until_next_month: float = (start_of_month + relativedelta(months=+1) - now).total_seconds()
+
+    cache.set_many(
+        {
+            f"monthly_usage_counter_{organization_id}": {
+                "start_of_month": start_of_month,
+                "watermark": watermark,
+                "total": total,
+                "recount_at": recount_at,
+            }
+            for organization_id, total in usage.items()
+        },
+        seconds_until_next_month,
+    )
+    cache.set_many(
+        {f"monthly_usage_{organization_id}": total for organization_id, total in usage.items()},
+        min(EVENT_USAGE_CACHING_TTL, seconds_until_next_month),
+    )  # cache result for default time or until next month
+
+
+def refresh_monthly_event_usage(organization: Organization) -> Optional[int]:
+    """
+    Computes the number of events used in the current calendar month and caches the result. A running total and a
+    watermark are kept per organization so that only the events after the watermark have to be counted. A full
+    count is only done at the beginning of each month and every `EVENT_USAGE_FULL_RECOUNT_INTERVAL` seconds (to
+    account for events ingested late).
+    """
+
     now: datetime.datetime = timezone.now()
-    result: int = get_monthly_event_usage(organization=organization, at_date=now)
+    start_of_month: datetime.datetime = _get_start_of_month(now)
+    watermark: datetime.datetime = _get_usage_watermark(now)
+
+    counter: Optional[Dict] = cache.get(f"monthly_usage_counter_{organization.id}")
+
+    if counter and counter["start_of_month"] == start_of_month and counter["recount_at"] > now:
+        new_usage = get_event_usage_after(
+            organization=organization, after_time=counter["watermark"], end_time=watermark,
+        )
+        result: Optional[int] = counter["total"] + new_usage if new_usage is not None else None
+        recount_at: datetime.datetime = counter["recount_at"]
+    else:
+        result = get_event_usage_with_rollup(organization=organization, start_time=start_of_month, end_time=watermark)
+        recount_at = now + datetime.timedelta(seconds=EVENT_USAGE_FULL_RECOUNT_INTERVAL)
 
     if result is None:
         # Don't cache unavailable/error result
         return result
 
-    # Cache the result
-    start_of_next_month = datetime.datetime.combine(
-        datetime.datetime(now.year, now.month, 1), datetime.time.min,
-    ).replace(tzinfo=pytz.UTC) + relativedelta(months=+1)
+    _set_cached_monthly_event_usage({str(organization.id): result}, now, watermark, recount_at)
+
+    return result
+
+
+def get_event_quota(api_token: str) -> Optional[Dict]:
+    """
+    Returns the precomputed event quota of the organization a team belongs to (by the team's API token) as a
+    `{"allocation", "usage", "over_limit"}` dict, with a single cache lookup and no database queries. Intended for
+    the ingestion path. Returns `None` if the quota is unknown (see `cache_event_quotas_for_organizations`).
+    """
+    return cache.get(_get_event_quota_key(api_token))
+
+
+def is_over_event_quota(api_token: str) -> bool:
+    """
+    Returns whether the organization of a team has exceeded its event allocation for the current month. Unknown
+    quotas are never considered over the limit.
+    """
+    quota: Optional[Dict] = get_event_quota(api_token)
+    return bool(quota and quota["over_limit"])
+
+
+def _get_event_quota_key(api_token: str) -> str:
+    return f"billing_quota_{api_token}"
+
+
+def cache_event_quotas_for_organizations(organization_ids: List[str]) -> bool:
+    """
+    Computes the event allocation and the monthly event usage (one grouped query) of multiple organizations and
+    caches the quota of each of their teams, keyed by API token (see `get_event_quota`). Returns `False` if usage
+    could not be computed.
+    """
+
+    now: datetime.datetime = timezone.now()
+    watermark: datetime.datetime = _get_usage_watermark(now)
+
+    usage = get_organizations_event_usage_with_rollup(
+        organization_ids=organization_ids, start_time=_get_start_of_month(now), end_time=watermark,
+    )
+
+    if usage is None:
+        return False
+
+    # The monthly usage cache is warmed as well, as it's computed the same way (see `get_cached_monthly_event_usage`)
+    _set_cached_monthly_event_usage(
+        usage, now, watermark, now + datetime.timedelta(seconds=EVENT_USAGE_FULL_RECOUNT_INTERVAL),
+    )
+
+    allocations: Dict[str, Optional[int]] = {
+        organization_id: settings.BILLING_NO_PLAN_EVENT_ALLOCATION for organization_id in usage.keys()
+    }  # organizations without billing are on the no-plan allocation
+    for instance in OrganizationBilling.objects.filter(pk__in=organization_ids):  # plans are read from the registry
+        allocations[str(instance.pk)] = instance.event_allocation
+
+    quotas: Dict[str, Dict] = {
+        organization_id: {
+            "allocation": allocation,
+            "usage": usage[organization_id],
+            "over_limit": allocation is not None and usage[organization_id] >= allocation,
+        }
+        for organization_id, allocation in allocations.items()
+    }
+
+    cache.set_many(
+        {
+            _get_event_quota_key(api_token): quotas[str(organization_id)]
+            for api_token, organization_id in Team.objects.filter(organization_id__in=organization_ids).values_list(
+                "api_token", "organization_id",
+            )
+        },
+        EVENT_QUOTA_TTL,
+    )
+
+    return True
+
+
+def get_cached_current_usage_bill(subscription_id: str) -> Optional[Decimal]:
+    """
+    Returns the cached amount (in $) of the upcoming invoice of a metered subscription. Results will be cached for
+    `CURRENT_BILL_CACHING_TTL`; once they expire, the previous amount is returned right away and refreshed in the
+    background.
+    """
+
+    cached_result: Optional[Dict] = cache.get(_get_current_bill_key(subscription_id))
+
+    if cached_result is None:
+        return refresh_current_usage_bill(subscription_id)
+
+    if cached_result["expires_at"] <= timezone.now() and cache.add(
+        _get_current_bill_refresh_lock_key(subscription_id), True, CURRENT_BILL_REFRESH_LOCK_TIMEOUT,
+    ):
+        from multi_tenancy.tasks import refresh_current_usage_bill_for_subscription  # tasks depend on `utils`
+
+        try:
+            refresh_current_usage_bill_for_subscription.delay(subscription_id=subscription_id)
+        except Exception as e:
+            # The task won't release the lock (e.g. the broker is unavailable)
+            release_current_usage_bill_refresh_lock(subscription_id)
+            capture_exception(e)
+
+    return cached_result["amount"]
+
+
+def refresh_current_usage_bill(subscription_id: str, retry_on_rate_limit: bool = False) -> Optional[Decimal]:
+    """
+    Obtains the amount of the upcoming invoice of a subscription from Stripe and caches it. Failed requests are not
+    cached. Only background tasks should pass `retry_on_rate_limit` (see `stripe._request`).
+    """
+
+    try:
+        amount: Optional[Decimal] = get_current_usage_bill(subscription_id, retry_on_rate_limit=retry_on_rate_limit)
+    except Exception as e:
+        capture_exception(e)
+        return None
 
     cache.set(
-        cache_key,
-        result,
-        min(
-            EVENT_USAGE_CACHING_TTL,
-            (start_of_next_month - timezone.now()).total_seconds(),
-        ),
-    )  # cache result for default time or until next month
+        _get_current_bill_key(subscription_id),
+        {"amount": amount, "expires_at": timezone.now() + datetime.timedelta(seconds=CURRENT_BILL_CACHING_TTL)},
+        CURRENT_BILL_STALE_TTL,
+    )
 
-    return result
+    return amount
+
+
+def invalidate_cached_current_usage_bills(subscription_ids: List[str]) -> None:
+    """
+    Clears the cached upcoming invoice amounts, e.g. after new usage has been reported for the subscriptions.
+    """
+    cache.delete_many([_get_current_bill_key(subscription_id) for subscription_id in subscription_ids])
+
+
+def release_current_usage_bill_refresh_lock(subscription_id: str) -> None:
+    cache.delete(_get_current_bill_refresh_lock_key(subscription_id))
+
+
+def _get_current_bill_key(subscription_id: str) -> str:
+    return f"current_bill_{subscription_id}"
+
+
+def _get_current_bill_refresh_lock_key(subscription_id: str) -> str:
+    return f"current_bill_refresh_lock_{subscription_id}"
+
+
+def get_current_team_snapshot(user: User) -> Dict[str, str]:
+    """
+    Returns the API token and name of the user's current team (an empty dict if the user has no team). Cached per
+    user and invalidated whenever the team is changed or the user switches teams (see `multi_tenancy.signals`).
+    """
+
+    cache_key: str = _get_current_team_key(user.id)
+    snapshot: Optional[Dict[str, str]] = cache.get(cache_key)
+
+    if snapshot is None:
+        team: Optional[Team] = user.team
+        snapshot = {"api_token": team.api_token, "name": team.name} if team else {}
+        cache.set(cache_key, snapshot, CURRENT_TEAM_CACHING_TTL)
+
+    return snapshot
+
+
+def invalidate_current_team_snapshots(user_ids: List[int]) -> None:
+    cache.delete_many([_get_current_team_key(user_id) for user_id in user_ids])
+
+
+def _get_current_team_key(user_id: int) -> str:
+    return f"current_team_{user_id}"
 
 
 def get_billing_cycle_anchor(at_date: datetime.datetime) -> datetime.datetime:
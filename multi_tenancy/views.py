@@ -1,10 +1,11 @@
-import json
+import datetime
 import logging
 from distutils.util import strtobool
 from typing import Dict, Optional
 
 import posthoganalytics
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.template.exceptions import TemplateDoesNotExist
@@ -13,15 +14,24 @@ from django.views.decorators.csrf import csrf_exempt
 from posthog.api.organization import OrganizationSignupViewset
 from posthog.urls import render_template
 from rest_framework import mixins, status
+from rest_framework.request import Request
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
-from sentry_sdk import capture_exception, capture_message
-
-import stripe
-from multi_tenancy.tasks import report_card_validated, update_subscription_billing_period
-
-from .models import OrganizationBilling, Plan
-from .serializers import BillingSerializer, BillingSubscribeSerializer, MultiTenancyOrgSignupSerializer, PlanSerializer
-from .stripe import cancel_payment_intent, customer_portal_url, parse_webhook, set_default_payment_method_for_customer
+from sentry_sdk import capture_exception
+
+from multi_tenancy.tasks import process_stripe_webhook_event
+
+from .models import OrganizationBilling, Plan, StripeWebhookEvent
+from .serializers import (
+    BillingSerializer,
+    BillingSubscribeSerializer,
+    BillingUsageSerializer,
+    MultiTenancyOrgSignupSerializer,
+    PlanSerializer,
+)
+from .stripe import customer_portal_url, parse_webhook
+from .utils import get_cached_event_usage_breakdown
+from .webhooks import ingest_stripe_webhook_event, is_handled_event_type
 
 logger = logging.getLogger(__name__)
 
@@ -52,11 +62,58 @@ class BillingViewset(mixins.RetrieveModelMixin, GenericViewSet):
         return instance
 
 
+class BillingUsageViewset(GenericViewSet):
+    """
+    Returns the number of events ingested by each team of the organization on each day of a date range.
+    """
+
+    serializer_class = BillingUsageSerializer
+
+    def list(self, request: Request) -> Response:
+        serializer = self.get_serializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        date_from: datetime.date = serializer.validated_data["date_from"]
+        date_to: datetime.date = serializer.validated_data["date_to"]
+
+        return Response(
+            {
+                "date_from": date_from,
+                "date_to": date_to,
+                "teams": get_cached_event_usage_breakdown(
+                    organization=request.user.organization, date_from=date_from, date_to=date_to,
+                ),
+            },
+        )
+
+
 class BillingSubscribeViewset(mixins.CreateModelMixin, GenericViewSet):
     serializer_class = BillingSubscribeSerializer
 
 
 def stripe_checkout_view(request: HttpRequest):
+    if not request.GET.get("session_id"):
+        # Checkout sessions are created lazily, only when the user actually intends to set up billing
+        if not request.user.is_authenticated:
+            return HttpResponse("Unauthorized", status=status.HTTP_401_UNAUTHORIZED)
+
+        instance, _ = OrganizationBilling.objects.get_or_create(organization=request.user.organization,)
+
+        if not instance.should_setup_billing or instance.is_billing_active:
+            return redirect("/")
+
+        checkout_session: Optional[str] = None
+        try:
+            checkout_session = instance.get_or_create_checkout_session(
+                user=request.user, base_url=request.build_absolute_uri("/"),
+            )
+        except ImproperlyConfigured as e:
+            capture_exception(e)
+
+        if not checkout_session:
+            return redirect("/billing/failed")
+
+        return redirect(f"/billing/setup?session_id={checkout_session}")
+
     return render_template(
         "stripe-checkout.html", request, {"STRIPE_PUBLISHABLE_KEY": settings.STRIPE_PUBLISHABLE_KEY},
     )
@@ -108,71 +165,40 @@ def billing_hosted_view(request: HttpRequest):
 
 @csrf_exempt
 def stripe_webhook(request: HttpRequest) -> JsonResponse:
+    """
+    Receives Stripe webhooks. Events are only verified and stored here, and processed asynchronously to keep response
+    times low (slow responses cause Stripe to deliver the same event again).
+    """
     response: JsonResponse = JsonResponse({"success": True}, status=status.HTTP_200_OK)
     error_response: JsonResponse = JsonResponse(
         {"success": False}, status=status.HTTP_400_BAD_REQUEST,
     )
     signature: str = request.META.get("HTTP_STRIPE_SIGNATURE", "")
+    payload: bytes = request.read()
 
     try:
-        event: Dict = parse_webhook(request.read(), signature)
+        event: Dict = parse_webhook(payload, signature)
     except Exception as e:
         capture_exception(e)
         return error_response
 
-    try:
-        customer_id = event["data"]["object"]["customer"]
-
-        try:
-            instance = OrganizationBilling.objects.get(stripe_customer_id=customer_id)
-        except OrganizationBilling.DoesNotExist:
-            capture_message(
-                f"Received invoice.payment_succeeded for {customer_id} but customer is not in the database.",
-            )
-            return response
-
-        if event["type"] == "invoice.payment_succeeded":
-            subscription_id: str = event["data"]["object"]["subscription"]
-
-            if instance.stripe_subscription_id:
-                if instance.stripe_subscription_id != subscription_id:
-                    capture_message(
-                        "Stripe webhook does not match subscription on file "
-                        f"({instance.stripe_subscription_id}): {json.dumps(event)}",
-                        "error",
-                    )
-                    return error_response
-            else:
-                # First time receiving the subscription_id, record it
-                instance.stripe_subscription_id = subscription_id
-
-            instance.should_setup_billing = False
-            instance.save()
-
-            update_subscription_billing_period.delay(organization_id=instance.organization.id)
-
-        # Special handling for plans that only do card validation (e.g. startup or metered-billing plans)
-        elif event["type"] == "payment_intent.amount_capturable_updated":
-            instance = instance.handle_post_card_validation()
-
-            # Attempt to cancel the validation charge
-            try:
-                cancel_payment_intent(event["data"]["object"]["id"])
-            except stripe.error.StripeError as e:
-                capture_exception(e)
-
-            # Attempt to set the newly added card as default
-            try:
-                set_default_payment_method_for_customer(customer_id, event["data"]["object"]["payment_method"])
-            except stripe.error.StripeError as e:
-                capture_exception(e)
-
-            report_card_validated(organization_id=instance.organization.id)
-
-    except KeyError:
+    if "id" not in event or "type" not in event:
         # Malformed request
         return error_response
 
+    if not is_handled_event_type(event["type"]):
+        # We're not interested in this event (e.g. events of VPC / enterprise customers)
+        return response
+
+    if "customer" not in event.get("data", {}).get("object", {}):
+        # Malformed request, all handled events relate to a customer
+        return error_response
+
+    webhook_event: Optional[StripeWebhookEvent] = ingest_stripe_webhook_event(event, payload.decode("utf-8"))
+
+    if webhook_event:  # otherwise it's a duplicate delivery
+        process_stripe_webhook_event.delay(webhook_event_id=webhook_event.pk)
+
     return response
 
 
@@ -0,0 +1,226 @@
+import datetime
+import json
+from typing import Callable, Dict, List, Optional
+
+import pytz
+from django.db.models import Q
+from django.utils import timezone
+from sentry_sdk import capture_exception, capture_message, push_scope
+
+import stripe
+from multi_tenancy.tasks import (
+    report_card_validated,
+    report_invoice_payment_failed,
+    update_subscription_billing_period,
+)
+
+from .models import OrganizationBilling, StripeWebhookEvent
+from .stripe import cancel_payment_intent, get_subscription, set_default_payment_method_for_customer
+
+WebhookHandler = Callable[[OrganizationBilling, Dict], None]
+
+# Events still being processed after this long are considered abandoned (e.g. the worker died) and can be claimed again
+WEBHOOK_EVENT_PROCESSING_TIMEOUT: datetime.timedelta = datetime.timedelta(minutes=30)
+
+_handlers: Dict[str, WebhookHandler] = {}
+
+
+def webhook_handler(event_type: str) -> Callable[[WebhookHandler], WebhookHandler]:
+    """
+    Registers the handler for a type of Stripe webhook event. Handlers receive the billing of the customer the event
+    refers to and the event itself. Events of types without a handler are ignored.
+    """
+
+    def decorator(handler: WebhookHandler) -> WebhookHandler:
+        _handlers[event_type] = handler
+        return handler
+
+    return decorator
+
+
+def is_handled_event_type(event_type: str) -> bool:
+    return event_type in _handlers
+
+
+def get_handled_event_types() -> List[str]:
+    return list(_handlers.keys())
+
+
+def get_stale_processing_filter() -> Q:
+    """
+    Filter for events whose processing was abandoned (see `WEBHOOK_EVENT_PROCESSING_TIMEOUT`).
+    """
+
+    return Q(status=StripeWebhookEvent.PROCESSING) & (
+        Q(processing_started_at__isnull=True)
+        | Q(processing_started_at__lt=timezone.now() - WEBHOOK_EVENT_PROCESSING_TIMEOUT)
+    )
+
+
+def ingest_stripe_webhook_event(event: Dict, payload: str) -> Optional[StripeWebhookEvent]:
+    """
+    Stores a (verified) Stripe webhook event. Returns the stored event if it should be processed, or `None` if it's a
+    duplicate delivery of an event that has already been processed (or is being processed). Pending events are
+    returned again, as queuing them may have failed; processing claims the event, so queuing it twice is harmless.
+    """
+
+    webhook_event, created = StripeWebhookEvent.objects.get_or_create(
+        stripe_event_id=event["id"], defaults={"type": event["type"], "payload": payload},
+    )
+
+    if (
+        not created
+        and not StripeWebhookEvent.objects.filter(
+            Q(status__in=[StripeWebhookEvent.PENDING, StripeWebhookEvent.FAILED]) | get_stale_processing_filter(),
+            pk=webhook_event.pk,
+        ).exists()
+    ):
+        return None
+
+    return webhook_event
+
+
+def process_stripe_webhook_event_by_id(webhook_event_id: int) -> Optional[bool]:
+    """
+    Processes a stored Stripe webhook event. Each event is only processed once; events that failed (or whose
+    processing was abandoned) can be processed again. Returns whether processing succeeded, or `None` if the event was
+    already processed (or is being processed).
+    """
+
+    # Claim the event, so concurrent deliveries of the same event are not processed twice
+    if not StripeWebhookEvent.objects.filter(
+        Q(status__in=[StripeWebhookEvent.PENDING, StripeWebhookEvent.FAILED]) | get_stale_processing_filter(),
+        pk=webhook_event_id,
+    ).update(status=StripeWebhookEvent.PROCESSING, processing_started_at=timezone.now()):
+        return None
+
+    webhook_event = StripeWebhookEvent.objects.get(pk=webhook_event_id)
+
+    try:
+        handle_stripe_webhook_event(json.loads(webhook_event.payload))
+    except Exception as e:
+        with push_scope() as scope:
+            scope.set_tag("stripe_event_type", webhook_event.type)
+            capture_exception(e)
+        StripeWebhookEvent.objects.filter(pk=webhook_event.pk).update(status=StripeWebhookEvent.FAILED)
+        return False
+
+    StripeWebhookEvent.objects.filter(pk=webhook_event.pk).update(
+        status=StripeWebhookEvent.PROCESSED, processed_at=timezone.now(),
+    )
+    return True
+
+
+def handle_stripe_webhook_event(event: Dict) -> None:
+    """
+    Applies a Stripe webhook event with the handler registered for its type. Events are verified & stored by the
+    `stripe_webhook` view and processed asynchronously (see `tasks.process_stripe_webhook_event`).
+    """
+
+    handler: Optional[WebhookHandler] = _handlers.get(event["type"])
+
+    if not handler:
+        return
+
+    customer_id = event["data"]["object"]["customer"]
+
+    try:
+        instance = OrganizationBilling.objects.get(stripe_customer_id=customer_id)
+    except OrganizationBilling.DoesNotExist:
+        capture_message(
+            f"Received {event['type']} for {customer_id} but customer is not in the database.",
+        )
+        return
+
+    handler(instance, event)
+
+
+def _is_subscription_ended(subscription_id: str) -> bool:
+    subscription: Dict = get_subscription(subscription_id, retry_on_rate_limit=True)  # webhooks are processed async
+    return subscription.get("status") == "canceled" or bool(subscription.get("ended_at"))
+
+
+@webhook_handler("invoice.payment_succeeded")
+def handle_invoice_payment_succeeded(instance: OrganizationBilling, event: Dict) -> None:
+    subscription_id: str = event["data"]["object"]["subscription"]
+
+    if instance.stripe_subscription_id:
+        if instance.stripe_subscription_id != subscription_id:
+            capture_message(
+                "Stripe webhook does not match subscription on file "
+                f"({instance.stripe_subscription_id}): {json.dumps(event)}",
+                "error",
+            )
+            return
+    else:
+        if not instance.should_setup_billing and _is_subscription_ended(subscription_id):
+            # e.g. the final invoice of a (metered) subscription that has been deleted, which is paid afterwards
+            capture_message(
+                f"Received payment for ended subscription {subscription_id}, billing is not updated: "
+                f"{json.dumps(event)}",
+            )
+            return
+
+        # First time receiving the subscription_id (also for subscriptions started before it was stored), record it
+        instance.stripe_subscription_id = subscription_id
+
+    instance.should_setup_billing = False
+    instance.save()
+
+    update_subscription_billing_period.delay(organization_id=instance.organization.id)
+
+
+@webhook_handler("payment_intent.amount_capturable_updated")
+def handle_payment_intent_amount_capturable_updated(instance: OrganizationBilling, event: Dict) -> None:
+    """
+    Special handling for plans that only do card validation (e.g. startup or metered-billing plans).
+    """
+    instance = instance.handle_post_card_validation()
+
+    # Attempt to cancel the validation charge
+    try:
+        cancel_payment_intent(event["data"]["object"]["id"])
+    except stripe.error.StripeError as e:
+        capture_exception(e)
+
+    # Attempt to set the newly added card as default
+    try:
+        set_default_payment_method_for_customer(
+            instance.stripe_customer_id, event["data"]["object"]["payment_method"],
+        )
+    except stripe.error.StripeError as e:
+        capture_exception(e)
+
+    report_card_validated(organization_id=instance.organization.id)
+
+
+@webhook_handler("customer.subscription.updated")
+def handle_customer_subscription_updated(instance: OrganizationBilling, event: Dict) -> None:
+    # Subscription items may have changed, clear the cached metered subscription item
+    OrganizationBilling.objects.filter(pk=instance.pk).update(stripe_metered_subscription_item_id="")
+
+
+@webhook_handler("customer.subscription.deleted")
+def handle_customer_subscription_deleted(instance: OrganizationBilling, event: Dict) -> None:
+    subscription: Dict = event["data"]["object"]
+
+    if instance.stripe_subscription_id != subscription["id"]:
+        return  # not the current subscription (e.g. replaced before)
+
+    instance.stripe_subscription_id = ""
+    instance.stripe_metered_subscription_item_id = ""
+
+    if subscription.get("ended_at"):
+        # Billing stays active until the subscription actually ends
+        ended_at = datetime.datetime.utcfromtimestamp(subscription["ended_at"]).replace(tzinfo=pytz.utc)
+        if not instance.billing_period_ends or instance.billing_period_ends > ended_at:
+            instance.billing_period_ends = ended_at
+
+    instance.save()
+
+
+@webhook_handler("invoice.payment_failed")
+def handle_invoice_payment_failed(instance: OrganizationBilling, event: Dict) -> None:
+    report_invoice_payment_failed.delay(
+        organization_id=instance.organization.id, attempt_count=event["data"]["object"].get("attempt_count", 0),
+    )
@@ -15,6 +15,8 @@ if TEMPLATES and TEMPLATES[0] and TEMPLATES[0]["DIRS"] and isinstance(TEMPLATES[
 
 
 EVENT_USAGE_CACHING_TTL = get_from_env("EVENT_USAGE_CACHING_TTL", 12 * 60 * 60, type_cast=int)
+EVENT_USAGE_FULL_RECOUNT_INTERVAL = get_from_env("EVENT_USAGE_FULL_RECOUNT_INTERVAL", 24 * 60 * 60, type_cast=int)
+CURRENT_BILL_CACHING_TTL = get_from_env("CURRENT_BILL_CACHING_TTL", 60 * 60, type_cast=int)
 
 
 # Stripe settings
@@ -23,6 +25,8 @@ EVENT_USAGE_CACHING_TTL = get_from_env("EVENT_USAGE_CACHING_TTL", 12 * 60 * 60,
 STRIPE_API_KEY = os.environ.get("STRIPE_API_KEY", "")
 STRIPE_PUBLISHABLE_KEY = os.environ.get("STRIPE_PUBLISHABLE_KEY", "")
 STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET", "")
+STRIPE_MAX_REQUESTS_PER_SECOND = get_from_env("STRIPE_MAX_REQUESTS_PER_SECOND", 50, type_cast=int)
+STRIPE_MAX_RETRIES = get_from_env("STRIPE_MAX_RETRIES", 3, type_cast=int)
 
 
 # Business rules
@@ -30,5 +34,24 @@ STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET", "")
 
 BILLING_TRIAL_DAYS = get_from_env("BILLING_TRIAL_DAYS", 0, type_cast=int)
 BILLING_NO_PLAN_EVENT_ALLOCATION = get_from_env("BILLING_NO_PLAN_EVENT_ALLOCATION", optional=True, type_cast=int)
+BILLING_USAGE_CHUNK_SIZE = get_from_env("BILLING_USAGE_CHUNK_SIZE", 500, type_cast=int)
+BILLING_USAGE_REPORT_CONCURRENCY = get_from_env("BILLING_USAGE_REPORT_CONCURRENCY", 10, type_cast=int)
 
 MIDDLEWARE.append("multi_tenancy.middleware.PostHogTokenCookieMiddleware")
+
+
+# Periodic tasks
+# Celery merges these with the periodic tasks registered by the main repo (see posthog/celery.py)
+
+from celery.schedules import crontab  # noqa: E402
+
+CELERY_BEAT_SCHEDULE = {
+    "rollup-daily-team-usage": {
+        "task": "multi_tenancy.tasks.rollup_daily_team_usage",
+        "schedule": crontab(hour=0, minute=15),  # after the day is over (UTC)
+    },
+    "refresh-event-quotas": {
+        "task": "multi_tenancy.tasks.refresh_event_quotas",
+        "schedule": crontab(minute="*/15"),  # well within the TTL of the quotas & the monthly usage cache
+    },
+}